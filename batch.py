@@ -0,0 +1,115 @@
+import argparse
+import json
+import logging
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+from machine import Engine, Program, load_program, simulate
+from object_cache import ObjectCache
+from tracing import TraceLevel
+from translator import translate
+
+# program, input and output paths of a single run, the program is a Forth source (.4th) or a translated object
+Entry = tuple[str, str, str]
+
+# program images of the batch, installed once into every worker process by the pool initializer
+images: dict[str, Program] = {}
+
+
+def read_manifest(path: str) -> list[Entry]:
+    # one run per line: "program input output", "#" starts a comment
+    entries: list[Entry] = []
+    with open(path, encoding="utf-8") as file:
+        for number, line in enumerate(file, 1):
+            fields = line.split("#")[0].split()
+            if fields:
+                assert len(fields) == 3, f"manifest line {number} must be 'program input output'"
+                entries.append((fields[0], fields[1], fields[2]))
+    return entries
+
+
+def build(programs: list[str], optimized: bool = False, object_cache: ObjectCache | None = None) -> dict[str, Program]:
+    # every distinct source is translated once and every object is loaded once, in the parent process
+    loaded: dict[str, Program] = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for program in dict.fromkeys(programs):
+            path = program
+            if program.endswith(".4th"):
+                path = os.path.join(directory, f"{len(loaded)}.json")
+                translate(program, path, optimized=optimized, object_cache=object_cache)
+            loaded[program] = load_program(path)
+    return loaded
+
+
+def share(loaded: dict[str, Program]):
+    images.update(loaded)
+    # the summary of every run is written by the parent, not by the machine tracer of each worker
+    logging.getLogger().setLevel(logging.WARNING)
+
+
+def run(entry: Entry, engine: Engine) -> dict:
+    program, input_path, output_path = entry
+    result: dict = {"program": program, "input": input_path, "output": output_path}
+    try:
+        control_unit = simulate(program, input_path, output_path, TraceLevel.OFF, engine, keep_output=False,
+                                program=images[program])
+    except Exception as error:  # a failed run is reported in the summary and doesn't stop the batch
+        result.update(status=f"{type(error).__name__}: {error}", ticks=None, instructions=None)
+    else:
+        result.update(status="ok", ticks=control_unit.ticks, instructions=control_unit.instruction_counter)
+    return result
+
+
+def run_batch(entries: list[Entry], workers: int | None = None, engine: Engine = Engine.JIT,
+              optimized: bool = False, object_cache: ObjectCache | None = None) -> list[dict]:
+    loaded = build([program for program, _, _ in entries], optimized, object_cache)
+
+    workers = workers or os.cpu_count() or 1
+    # a few chunks per worker keep the pipe traffic low and still balance runs of different length
+    chunk_size = max(1, len(entries) // (workers * 4))
+    with ProcessPoolExecutor(workers, initializer=share, initargs=(loaded,)) as pool:
+        return list(pool.map(run, entries, repeat(engine), chunksize=chunk_size))
+
+
+def summary(results: list[dict], seconds: float) -> dict:
+    finished = [result for result in results if result["status"] == "ok"]
+    return {
+        "runs": len(results),
+        "failed": len(results) - len(finished),
+        "ticks": sum(result["ticks"] for result in finished),
+        "instructions": sum(result["instructions"] for result in finished),
+        "seconds": round(seconds, 3),
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate many programs and inputs in parallel")
+    parser.add_argument("manifest", help="file with one 'program input output' run per line")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, one per core when omitted")
+    parser.add_argument("--engine", type=Engine, choices=list(Engine), default=Engine.JIT,
+                        help="simulation engine, all of them count the same ticks")
+    parser.add_argument("-O", "--optimize", action="store_true", help="translate .4th sources with -O")
+    parser.add_argument("--cache", metavar="DIR", help="object cache directory for translated sources")
+    parser.add_argument("--summary", metavar="FILE", help="write the summary with every run to a JSON file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    manifest = read_manifest(args.manifest)
+    start = time.perf_counter()
+    batch = summary(run_batch(manifest, args.workers, args.engine, args.optimize,
+                              ObjectCache(args.cache) if args.cache else None), time.perf_counter() - start)
+
+    for result in batch["results"]:
+        logging.info(f"{result['program']} < {result['input']}: {result['status']}, "
+                     f"ticks: {result['ticks']}, instructions: {result['instructions']}")
+    logging.info(f"Runs: {batch['runs']}, failed: {batch['failed']}, ticks: {batch['ticks']}, "
+                 f"instructions: {batch['instructions']}, time: {batch['seconds']} s "
+                 f"({batch['runs'] / max(batch['seconds'], 1e-9):.1f} runs/s)")
+    if args.summary:
+        with open(args.summary, "w", encoding="utf-8") as file:
+            file.write(json.dumps(batch, indent=2))
+    raise SystemExit(1 if batch["failed"] else 0)
@@ -0,0 +1,187 @@
+import bisect
+import random
+from collections import Counter
+from enum import Enum
+
+
+class ReplacementPolicy(Enum):
+    LRU = "lru"
+    FIFO = "fifo"
+    RANDOM = "random"
+
+    def __str__(self):
+        return self.value
+
+
+class WritePolicy(Enum):
+    WRITE_BACK = "back"
+    WRITE_THROUGH = "through"
+
+    def __str__(self):
+        return self.value
+
+
+class Cache:
+    # Models tags and dirty bits only, the values themselves always live in the backing memory.
+    # Every access returns its latency in ticks.
+    def __init__(self, size: int = 256, line_size: int = 4, associativity: int = 2,
+                 replacement: ReplacementPolicy = ReplacementPolicy.LRU,
+                 write_policy: WritePolicy = WritePolicy.WRITE_BACK,
+                 hit_latency: int = 1, miss_latency: int = 10, prefetch: int = 0, seed: int = 0):
+        assert line_size > 0, "cache line size must be positive"
+        assert associativity > 0, "cache associativity must be positive"
+        assert prefetch >= 0, "prefetch distance can't be negative"
+        assert size > 0 and size % (line_size * associativity) == 0, \
+            "cache size must be a multiple of line size * associativity"
+
+        self.size = size
+        self.line_size = line_size
+        self.associativity = associativity
+        self.replacement = replacement
+        self.write_policy = write_policy
+        self.hit_latency = hit_latency
+        self.miss_latency = miss_latency
+        # lines following a read miss are brought in too, their memory access overlaps the miss
+        self.prefetch = prefetch
+
+        self.set_count = size // (line_size * associativity)
+        # tag: dirty, insertion order is the age of the line
+        self.sets: list[dict[int, bool]] = [{} for _ in range(self.set_count)]
+        self.random = random.Random(seed)
+
+        self.reads = 0
+        self.writes = 0
+        self.read_misses = 0
+        self.write_misses = 0
+        self.writebacks = 0
+        self.prefetches = 0
+        self.latency = 0
+        self.miss_addresses: Counter[int] = Counter()
+
+    def lookup(self, address: int) -> tuple[dict[int, bool], int]:
+        return self.locate(address // self.line_size)
+
+    def locate(self, line: int) -> tuple[dict[int, bool], int]:
+        return self.sets[line % self.set_count], line // self.set_count
+
+    def touch(self, lines: dict[int, bool], tag: int):
+        if self.replacement is ReplacementPolicy.LRU:
+            lines[tag] = lines.pop(tag)
+
+    def evict(self, lines: dict[int, bool]) -> int:
+        if len(lines) < self.associativity:
+            return 0
+        if self.replacement is ReplacementPolicy.RANDOM:
+            victim = self.random.choice(list(lines))
+        else:
+            victim = next(iter(lines))
+        if lines.pop(victim):
+            self.writebacks += 1
+            return self.miss_latency
+        return 0
+
+    def allocate(self, lines: dict[int, bool], tag: int, dirty: bool) -> int:
+        latency = self.miss_latency + self.evict(lines)
+        lines[tag] = dirty
+        return latency
+
+    def prefetch_lines(self, address: int) -> int:
+        latency = 0
+        line = address // self.line_size
+        for following in range(line + 1, line + 1 + self.prefetch):
+            lines, tag = self.locate(following)
+            if tag not in lines:
+                self.prefetches += 1
+                latency += self.evict(lines)
+                lines[tag] = False
+        return latency
+
+    def read(self, address: int) -> int:
+        self.reads += 1
+        lines, tag = self.lookup(address)
+
+        if tag in lines:
+            self.touch(lines, tag)
+            latency = self.hit_latency
+        else:
+            self.read_misses += 1
+            self.miss_addresses[address] += 1
+            latency = self.allocate(lines, tag, False) + self.prefetch_lines(address)
+
+        self.latency += latency
+        return latency
+
+    def write(self, address: int) -> int:
+        self.writes += 1
+        lines, tag = self.lookup(address)
+
+        if self.write_policy is WritePolicy.WRITE_THROUGH:
+            # no write allocate, every write goes to memory
+            if tag in lines:
+                self.touch(lines, tag)
+            else:
+                self.write_misses += 1
+                self.miss_addresses[address] += 1
+            latency = self.miss_latency
+        elif tag in lines:
+            self.touch(lines, tag)
+            lines[tag] = True
+            latency = self.hit_latency
+        else:
+            self.write_misses += 1
+            self.miss_addresses[address] += 1
+            latency = self.allocate(lines, tag, True)
+
+        self.latency += latency
+        return latency
+
+    @property
+    def accesses(self) -> int:
+        return self.reads + self.writes
+
+    @property
+    def misses(self) -> int:
+        return self.read_misses + self.write_misses
+
+    @property
+    def hits(self) -> int:
+        return self.accesses - self.misses
+
+
+cache_options = {
+    "size": ("size", int),
+    "line": ("line_size", int),
+    "ways": ("associativity", int),
+    "replacement": ("replacement", ReplacementPolicy),
+    "write": ("write_policy", WritePolicy),
+    "hit": ("hit_latency", int),
+    "miss": ("miss_latency", int),
+    "prefetch": ("prefetch", int),
+    "seed": ("seed", int),
+}
+
+
+def parse_cache(spec: str) -> Cache:
+    # "size=256,line=4,ways=2,replacement=lru,write=back,hit=1,miss=10,prefetch=1", omitted options keep their defaults
+    arguments = {}
+    for option in filter(None, spec.split(",")):
+        key, _, value = option.partition("=")
+        assert key in cache_options, f"unknown cache option {key}"
+        name, kind = cache_options[key]
+        arguments[name] = kind(value)
+    return Cache(**arguments)
+
+
+def misses_by_label(cache: Cache, labels: dict[str, int], first: str = "main") -> Counter[str]:
+    # Every miss is charged to the closest labelled address at or before it. Labels sharing an address (a procedure
+    # starting with a loop) are charged together under their names joined in program order.
+    names: dict[int, list[str]] = {}
+    for name, idx in labels.items():
+        names.setdefault(idx, []).append(name)
+    addresses = sorted(names)
+
+    result: Counter[str] = Counter()
+    for address, count in cache.miss_addresses.items():
+        position = bisect.bisect_right(addresses, address) - 1
+        result["/".join(names[addresses[position]]) if position >= 0 else first] += count
+    return result
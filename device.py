@@ -0,0 +1,52 @@
+from typing import TextIO
+
+
+class InputDevice:
+    def __init__(self, stream: TextIO, chunk_size: int = 4096):
+        self.stream = stream
+        self.chunk_size = chunk_size
+
+        self.buffer = ""
+        self.position = 0
+
+        self.exhausted = False
+
+    def read(self) -> int:
+        if self.position == len(self.buffer):
+            assert not self.exhausted, "input device is exhausted"
+
+            self.buffer = self.stream.read(self.chunk_size)
+            self.position = 0
+
+            if not self.buffer:
+                self.exhausted = True
+                return 0
+
+        char = self.buffer[self.position]
+        self.position += 1
+
+        return ord(char)
+
+
+class OutputDevice:
+    def __init__(self, stream: TextIO | None = None, chunk_size: int = 4096, keep_copy: bool = True):
+        self.stream = stream
+        self.chunk_size = chunk_size
+
+        self.pending: list[str] = []
+        self.buffer: list[int] | None = [] if keep_copy else None
+
+    def write(self, value: int):
+        if self.buffer is not None:
+            self.buffer.append(value)
+
+        if value != 0:
+            self.pending.append(chr(value))
+            if len(self.pending) >= self.chunk_size:
+                self.flush()
+
+    def flush(self):
+        if self.stream is not None and self.pending:
+            self.stream.write("".join(self.pending))
+            self.stream.flush()
+        self.pending.clear()
@@ -0,0 +1,23 @@
+class DigitBuffer:
+    # Binary to decimal converter feeding the output device: holds the character codes of a number,
+    # most significant first, with a leading '-' for negative numbers.
+    def __init__(self):
+        self.digits: list[int] = []
+
+    def load(self, value: int):
+        magnitude = abs(value)
+        digits = [ord("0") + magnitude % 10]
+        magnitude //= 10
+        while magnitude:
+            digits.append(ord("0") + magnitude % 10)
+            magnitude //= 10
+        if value < 0:
+            digits.append(ord("-"))
+        digits.reverse()
+        self.digits = digits
+
+    def __str__(self):
+        return "".join(map(chr, self.digits))
+
+    def __repr__(self):
+        return str(self)
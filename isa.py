@@ -1,3 +1,7 @@
+import mmap
+import struct
+import sys
+from array import array
 from enum import Enum
 
 
@@ -10,9 +14,11 @@ class OpCode(Enum):
 
     INC = "inc"
     DEC = "dec"
+    NOT = "not"
 
     READ = "read"
     SAVE = "save"
+    PRINT = "print"
 
     POP = "pop"
     PUSH = "push"
@@ -22,11 +28,13 @@ class OpCode(Enum):
     EQL = "eql"
     LESS = "less"
     LRG = "lrg"
+    COMP = "comp"
 
     JMP = "jmp"
-    JUZ = "juz"
+    JMZ = "jmz"
     JNZ = "jnz"
 
+    CALL = "call"
     RET = "ret"
 
     HLT = "hlt"
@@ -41,17 +49,61 @@ class OpCode(Enum):
 
 
 class Instruction:
-    def __init__(self, opcode: OpCode, operand: int | None = None):
+    # operand is a number, or a symbolic name of a variable or label until the linker resolves it
+    __slots__ = ("opcode", "operand")
+
+    def __init__(self, opcode: OpCode, operand: int | str | None = None):
         self.opcode = opcode
         self.operand = operand
 
+    def __eq__(self, other):
+        return isinstance(other, Instruction) and self.opcode is other.opcode and self.operand == other.operand
+
+    def __hash__(self):
+        return hash((self.opcode, self.operand))
+
+    def __str__(self):
+        return str(self.opcode) if self.operand is None else f"{self.opcode} {self.operand}"
+
+    def __repr__(self):
+        return str(self)
+
+
+class Label:
+    # jump target in assembly, takes no space in instruction memory
+    __slots__ = ("name",)
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __eq__(self, other):
+        return isinstance(other, Label) and self.name == other.name
+
+    def __hash__(self):
+        return hash(self.name)
+
     def __str__(self):
-        return f"{self.opcode.name} {self.operand}"
+        return f"{self.name}:"
 
     def __repr__(self):
         return str(self)
 
 
+Line = Instruction | Label
+
+
+def parse_line(text: str) -> Line:
+    # "name:" is a label, "opcode" or "opcode operand" an instruction, numeric operands become numbers
+    if text.endswith(":"):
+        return Label(text[:-1])
+    name, *operand = text.split()
+    if not operand:
+        return Instruction(OpCode(name))
+    value = operand[0]
+    is_number = value.isnumeric() or (value[0] == "-" and value[1:].isnumeric())
+    return Instruction(OpCode(name), int(value) if is_number else value)
+
+
 def get_opcode_by_name(name: str) -> OpCode:
     for op in OpCode:
         if op.name.lower() == name.lower():
@@ -59,6 +111,100 @@ def get_opcode_by_name(name: str) -> OpCode:
     return OpCode.NOP
 
 
+# Instruction word: opcode in bits 56..62, operand presence flag in bit 48,
+# signed operand in bits 0..47 (two's complement)
+OPCODE_SHIFT = 56
+OPERAND_FLAG = 1 << 48
+OPERAND_BITS = 48
+OPERAND_MASK = (1 << OPERAND_BITS) - 1
+
+opcodes: list[OpCode] = list(OpCode)
+opcode_codes: dict[OpCode, int] = {opcode: code for code, opcode in enumerate(opcodes)}
+
+
+def encode(opcode: OpCode, operand: int | str | None = None) -> int:
+    word = opcode_codes[opcode] << OPCODE_SHIFT
+    if operand is not None:
+        assert isinstance(operand, int), f"unresolved name {operand} in {opcode.value}"
+        assert -(1 << (OPERAND_BITS - 1)) <= operand < (1 << (OPERAND_BITS - 1)), \
+            f"operand {operand} doesn't fit into instruction word"
+        word |= OPERAND_FLAG | (operand & OPERAND_MASK)
+    return word
+
+
+def decode(word: int) -> Instruction:
+    opcode = opcodes[word >> OPCODE_SHIFT]
+    if not word & OPERAND_FLAG:
+        return Instruction(opcode)
+    return Instruction(opcode, decode_operand(word))
+
+
+def decode_operand(word: int) -> int:
+    operand = word & OPERAND_MASK
+    if operand >> (OPERAND_BITS - 1):
+        operand -= 1 << OPERAND_BITS
+    return operand
+
+
+# Object file: header, memory layout section of (idx, size) pairs, instruction words, optional label table
+# of (idx, name length, utf-8 name) records up to the end of the file.
+# All fields are little-endian, instruction words start at an 8 byte boundary.
+OBJECT_MAGIC = b"FTHO"
+OBJECT_VERSION = 3
+OBJECT_HEADER = struct.Struct("<4sHHII")
+OBJECT_VARIABLE = struct.Struct("<II")
+OBJECT_LABEL = struct.Struct("<IH")
+
+
+def is_object_file(path: str) -> bool:
+    with open(path, "rb") as file:
+        return file.read(len(OBJECT_MAGIC)) == OBJECT_MAGIC
+
+
+def write_object(path: str, memory: list[tuple[int, int]], instructions: list[int],
+                 labels: dict[str, int] | None = None):
+    with open(path, "wb") as file:
+        file.write(OBJECT_HEADER.pack(OBJECT_MAGIC, OBJECT_VERSION, 0, len(memory), len(instructions)))
+        for idx, size in memory:
+            file.write(OBJECT_VARIABLE.pack(idx, size))
+        words = array("q", instructions)
+        if sys.byteorder != "little":
+            words.byteswap()
+        file.write(words.tobytes())
+        for name, idx in (labels or {}).items():
+            encoded = name.encode("utf-8")
+            file.write(OBJECT_LABEL.pack(idx, len(encoded)))
+            file.write(encoded)
+
+
+def read_object(path: str) -> tuple[list[tuple[int, int]], array, dict[str, int]]:
+    with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as image:
+        view = memoryview(image)
+        magic, version, _, memory_count, instruction_count = OBJECT_HEADER.unpack_from(view)
+        assert magic == OBJECT_MAGIC, f"{path} is not an object file"
+        assert version == OBJECT_VERSION, f"unsupported object file version {version}"
+
+        offset = OBJECT_HEADER.size
+        memory = list(OBJECT_VARIABLE.iter_unpack(view[offset:offset + memory_count * OBJECT_VARIABLE.size]))
+        offset += memory_count * OBJECT_VARIABLE.size
+
+        words = array("q")
+        words.frombytes(view[offset:offset + instruction_count * 8])
+        if sys.byteorder != "little":
+            words.byteswap()
+        offset += instruction_count * 8
+
+        labels: dict[str, int] = {}
+        while offset < len(view):
+            idx, length = OBJECT_LABEL.unpack_from(view, offset)
+            offset += OBJECT_LABEL.size
+            labels[bytes(view[offset:offset + length]).decode("utf-8")] = idx
+            offset += length
+
+        view.release()
+        return memory, words, labels
+
+
 class Term(Enum):
     EQUALS = "="
     LESS = "<"
@@ -100,8 +246,8 @@ class Term(Enum):
         return str(self)
 
 
+terms_by_name: dict[str, Term] = {term.name.lower(): term for term in Term}
+
+
 def get_term_by_name(name: str) -> Term:
-    for term in Term:
-        if term.name.lower() == name.lower():
-            return term
-    return Term.NOP
+    return terms_by_name.get(name.lower(), Term.NOP)
@@ -1,10 +1,19 @@
-import sys
+import argparse
+import contextlib
+import io
 import logging
 import json
+import sys
 from alu import ALU
-from stack import Stack
-from memory import Memory
+from stack import FixedStack, Stack, TosStack
+from cache import Cache, misses_by_label, parse_cache
+from memory import ArrayMemory, Memory, memory_models
+from device import InputDevice, OutputDevice
+from digits import DigitBuffer
+from tracing import TraceLevel, Tracer
+from isa import OPCODE_SHIFT, OPERAND_FLAG, OpCode, decode, decode_operand, encode, is_object_file, opcodes, read_object
 from enum import Enum
+from typing import Any, Callable, ContextManager, Sequence, TextIO
 
 
 class ReturnStackSignal(Enum):
@@ -16,6 +25,10 @@ class DataStackSignal(Enum):
     PUSH = 1
     POP = 2
     SWAP = 3
+    # only with the TOS register
+    REPLACE = 4
+    SPILL = 5
+    POP_TWO = 6
 
 
 class DataMemorySignal(Enum):
@@ -39,17 +52,22 @@ class IpMuxSignal(Enum):
     DS = 2
     RS = 3
     ALU = 4
+    OPERAND = 5
 
 
 class DsMuxSignal(Enum):
     DS = 1
     DM = 2
     ALU = 3
+    OPERAND = 4
 
 
 class DmMuxSignal(Enum):
     DS = 1
     ALU = 2
+    OPERAND = 3
+    # only with the TOS register: the value right under it
+    NOS = 4
 
 
 class AluSignal(Enum):
@@ -70,18 +88,21 @@ class AluSignal(Enum):
 
 class AluMuxSignalA(Enum):
     DS = 1
-    IM = 2
-    ALU = 3
-    ZERO = 4
-    ONE = 5
+    ALU = 2
+    ZERO = 3
+    ONE = 4
 
 
 class AluMuxSignalB(Enum):
     DS = 1
-    IM = 2
-    ALU = 3
-    ZERO = 4
-    ONE = 5
+    ALU = 2
+    ZERO = 3
+    ONE = 4
+
+
+class DigitBufferSignal(Enum):
+    LOAD = 1
+    WRITE = 2
 
 
 class ControlSignal(Enum):
@@ -107,12 +128,21 @@ class MUX:
 
 
 class DataPath:
-    def __init__(self):
-        self.data_memory: Memory = Memory()
-        self.instruction_memory: Memory = Memory()
-
-        self.return_stack: Stack = Stack()
-        self.data_stack: Stack = Stack()
+    def __init__(self, data_memory: Memory | ArrayMemory | None = None,
+                 instruction_memory: Memory | ArrayMemory | None = None,
+                 data_stack: Stack | None = None, return_stack: Stack | None = None,
+                 data_cache: Cache | None = None, instruction_cache: Cache | None = None):
+        self.data_memory: Memory | ArrayMemory = data_memory if data_memory is not None else Memory()
+        self.instruction_memory: Memory | ArrayMemory = \
+            instruction_memory if instruction_memory is not None else Memory()
+
+        self.return_stack: Stack = return_stack if return_stack is not None else Stack()
+        self.data_stack: Stack = data_stack if data_stack is not None else Stack()
+
+        self.data_cache: Cache | None = data_cache
+        self.instruction_cache: Cache | None = instruction_cache
+        # memory hierarchy latency not covered by microcode, the control unit adds it to its ticks
+        self.stall_ticks: int = 0
 
         self.alu = ALU()
 
@@ -122,202 +152,468 @@ class DataPath:
         self.alu_mux_a = MUX()
         self.alu_mux_b = MUX()
 
-        self.input_buffer: list[int] = []
-        self.output_buffer: list[int] = []
+        self.input_device: InputDevice = InputDevice(io.StringIO())
+        self.output_device: OutputDevice = OutputDevice()
+        self.digit_buffer = DigitBuffer()
 
         self.instruction_pointer: int = 0
         self.instruction_register: int = 0
 
+        # decoded from the instruction word together with the opcode
         self.operand_flag: int = 0
+        self.operand_register: int = 0
 
         self.exit_flag: int = 0
 
-        self.handle_signal = {
-            ReturnStackSignal: self.return_stack_signal,
-            DataStackSignal: self.data_stack_signal,
-            DataMemorySignal: self.data_memory_signal,
-            InstructionMemorySignal: self.instruction_memory_signal,
-            LatchSignal: self.latch,
-            IpMuxSignal: self.ip_mux_choice,
-            DsMuxSignal: self.ds_mux_choice,
-            DmMuxSignal: self.dm_mux_choice,
-            AluSignal: self.alu_signal,
-            AluMuxSignalA: self.alu_mux_a_choice,
-            AluMuxSignalB: self.alu_mux_b_choice,
-            JumpSignal: self.jump_signal,
-            ControlSignal: self.control_signal,
+        self.signals: dict[Enum, Callable[[], None]] = {
+            **self.return_stack_signals(),
+            **self.data_stack_signals(),
+            **self.data_memory_signals(),
+            **self.instruction_memory_signals(),
+            **self.latch_signals(),
+            **self.ip_mux_signals(),
+            **self.ds_mux_signals(),
+            **self.dm_mux_signals(),
+            **self.alu_signals(),
+            **self.alu_mux_a_signals(),
+            **self.alu_mux_b_signals(),
+            **self.jump_signals(),
+            **self.digit_buffer_signals(),
+            **self.control_signals(),
         }
 
-    def return_stack_signal(self, signal: ReturnStackSignal):
-        match signal:
-            case ReturnStackSignal.PUSH:
-                self.return_stack.push(self.instruction_pointer)
-            case ReturnStackSignal.POP:
-                self.return_stack.pop()
-
-    def data_stack_signal(self, signal: DataStackSignal):
-        match signal:
-            case DataStackSignal.PUSH:
-                self.data_stack.push(self.ds_mux.get())
-            case DataStackSignal.POP:
-                self.data_stack.pop()
-            case DataStackSignal.SWAP:
-                self.data_stack.swap()
-
-    def data_memory_signal(self, signal: DataMemorySignal):
-        match signal:
-            case DataMemorySignal.WRITE:
-                assert self.data_memory.address_register != 0, "can't write to input device"
-                if self.data_memory.address_register == 1:
-                    self.output_buffer.append(self.dm_mux.get())
-                else:
-                    self.data_memory.write(self.dm_mux.get())
-            case DataMemorySignal.READ:
-                assert self.data_memory.address_register != 1, "can't read from output device"
-                if self.data_memory.address_register == 0:
-                    self.data_memory.data_register = self.input_buffer.pop(0)
-                else:
-                    self.data_memory.read()
-            case DataMemorySignal.SET_ADDRESS:
-                self.data_memory.address_register = self.dm_mux.get()
-
-    def instruction_memory_signal(self, signal: InstructionMemorySignal):
-        match signal:
-            case InstructionMemorySignal.READ:
-                self.instruction_memory.read()
-            case InstructionMemorySignal.SET_ADDRESS:
-                self.instruction_memory.address_register = self.instruction_pointer
-
-    def ip_mux_choice(self, signal: IpMuxSignal):
-        match signal:
-            case IpMuxSignal.IP:
-                self.ip_mux.choose(self.instruction_pointer + 1)
-            case IpMuxSignal.DS:
-                self.ip_mux.choose(self.data_stack.peek())
-            case IpMuxSignal.RS:
-                self.ip_mux.choose(self.return_stack.peek())
-            case IpMuxSignal.ALU:
-                self.ip_mux.choose(self.alu.result)
-
-    def ds_mux_choice(self, signal: DsMuxSignal):
-        match signal:
-            case DsMuxSignal.DS:
-                self.ds_mux.choose(self.data_stack.peek())
-            case DsMuxSignal.DM:
-                self.ds_mux.choose(self.data_memory.data_register)
-            case DsMuxSignal.ALU:
-                self.ds_mux.choose(self.alu.result)
-
-    def dm_mux_choice(self, signal: DmMuxSignal):
-        match signal:
-            case DmMuxSignal.DS:
-                self.dm_mux.choose(self.data_stack.peek())
-            case DmMuxSignal.ALU:
-                self.dm_mux.choose(self.alu.result)
-
-    def alu_mux_a_choice(self, signal: AluMuxSignalA):
-        match signal:
-            case AluMuxSignalA.DS:
-                self.alu_mux_a.choose(self.data_stack.peek())
-            case AluMuxSignalA.ZERO:
-                self.alu_mux_a.choose(0)
-            case AluMuxSignalA.ONE:
-                self.alu_mux_a.choose(1)
-            case AluMuxSignalA.ALU:
-                self.alu_mux_a.choose(self.alu.result)
-            case AluMuxSignalA.IM:
-                if "operand" in self.instruction_memory.data_register.keys():
-                    self.alu_mux_a.choose(self.instruction_memory.data_register["operand"])
-                    self.operand_flag = 1
-                else:
-                    self.alu_mux_a.choose(0)
-                    self.operand_flag = 0
-
-    def alu_mux_b_choice(self, signal: AluMuxSignalB):
-        match signal:
-            case AluMuxSignalB.DS:
-                self.alu_mux_b.choose(self.data_stack.peek())
-            case AluMuxSignalB.ZERO:
-                self.alu_mux_b.choose(0)
-            case  AluMuxSignalB.ONE:
-                self.alu_mux_b.choose(1)
-            case AluMuxSignalB.ALU:
-                self.alu_mux_b.choose(self.alu.result)
-            case AluMuxSignalB.IM:
-                if "operand" in self.instruction_memory.data_register.keys():
-                    self.alu_mux_b.choose(self.instruction_memory.data_register["operand"])
-                    self.operand_flag = 1
-                else:
-                    self.alu_mux_b.choose(0)
-                    self.operand_flag = 0
-
-    def latch(self, signal: LatchSignal):
-        match signal:
-            case LatchSignal.IP:
-                self.instruction_pointer = self.ip_mux.get()
-            case LatchSignal.IR:
-                self.instruction_register = self.instruction_memory.data_register["opcode"]
-
-    def alu_signal(self, signal: AluSignal):
-        match signal:
-            case AluSignal.ADD:
-                self.alu.add()
-            case AluSignal.SUB:
-                self.alu.sub()
-            case AluSignal.MUL:
-                self.alu.mul()
-            case AluSignal.DIV:
-                self.alu.div()
-            case AluSignal.MOD:
-                self.alu.mod()
-            case AluSignal.COMP:
-                self.alu.compare()
-            case AluSignal.EQUALS:
-                self.alu.equals()
-            case AluSignal.LESS:
-                self.alu.less()
-            case AluSignal.GREATER:
-                self.alu.greater()
-            case AluSignal.SET_A:
-                self.alu.a = self.alu_mux_a.get()
-            case AluSignal.SET_B:
-                self.alu.b = self.alu_mux_b.get()
-            case AluSignal.NOT_A:
-                self.alu.not_a()
-            case AluSignal.NOT_B:
-                self.alu.not_b()
-
-    def jump_signal(self, signal: JumpSignal):
-        match signal:
-            case JumpSignal.JMP:
-                self.return_stack.push(self.instruction_pointer)
-                self.instruction_pointer = self.ip_mux.get()
-            case JumpSignal.JMZ:
-                if self.data_stack.peek() == 0:
-                    self.return_stack.push(self.instruction_pointer)
-                    self.instruction_pointer = self.ip_mux.get()
-            case JumpSignal.JNZ:
-                if self.data_stack.peek() != 0:
-                    self.return_stack.push(self.instruction_pointer)
-                    self.instruction_pointer = self.ip_mux.get()
-
-    def control_signal(self, signal: ControlSignal):
-        match signal:
-            case ControlSignal.HALT:
-                self.exit_flag = 1
-            case ControlSignal.NOP:
-                pass
+    @property
+    def output_buffer(self) -> list[int] | None:
+        return self.output_device.buffer
+
+    def load(self, address: int) -> int:
+        assert address != 1, "can't read from output device"
+        if address == 0:
+            return self.input_device.read()
+        if self.data_cache is not None:
+            self.stall_ticks += self.data_cache.read(address)
+        self.data_memory.address_register = address
+        return self.data_memory.read()
+
+    def store(self, address: int, value: int):
+        assert address != 0, "can't write to input device"
+        if address == 1:
+            self.output_device.write(value)
+        else:
+            if self.data_cache is not None:
+                self.stall_ticks += self.data_cache.write(address)
+            self.data_memory.address_register = address
+            self.data_memory.write(value)
+
+    def return_stack_signals(self) -> dict[Enum, Callable[[], None]]:
+        return_stack = self.return_stack
+
+        def push():
+            return_stack.push(self.instruction_pointer)
+
+        return {
+            ReturnStackSignal.PUSH: push,
+            ReturnStackSignal.POP: return_stack.pop,
+        }
+
+    def data_stack_signals(self) -> dict[Enum, Callable[[], None]]:
+        data_stack = self.data_stack
+        ds_mux = self.ds_mux
+
+        def push():
+            data_stack.push(ds_mux.mux_value)
+
+        signals: dict[Enum, Callable[[], None]] = {
+            DataStackSignal.PUSH: push,
+            DataStackSignal.POP: data_stack.pop,
+            DataStackSignal.SWAP: data_stack.swap,
+        }
+
+        if isinstance(data_stack, TosStack):
+            tos_stack = data_stack
+
+            def replace():
+                tos_stack.replace(ds_mux.mux_value)
+
+            signals[DataStackSignal.REPLACE] = replace
+            signals[DataStackSignal.SPILL] = tos_stack.spill
+            signals[DataStackSignal.POP_TWO] = tos_stack.pop_two
+
+        return signals
+
+    def data_memory_signals(self) -> dict[Enum, Callable[[], None]]:
+        data_memory = self.data_memory
+        dm_mux = self.dm_mux
+
+        def write():
+            self.store(data_memory.address_register, dm_mux.mux_value)
+
+        def read():
+            data_memory.data_register = self.load(data_memory.address_register)
+
+        def set_address():
+            data_memory.address_register = dm_mux.mux_value
+
+        return {
+            DataMemorySignal.WRITE: write,
+            DataMemorySignal.READ: read,
+            DataMemorySignal.SET_ADDRESS: set_address,
+        }
+
+    def instruction_memory_signals(self) -> dict[Enum, Callable[[], None]]:
+        instruction_memory = self.instruction_memory
+
+        def set_address():
+            instruction_memory.address_register = self.instruction_pointer
+
+        def read():
+            if self.instruction_cache is not None:
+                self.stall_ticks += self.instruction_cache.read(instruction_memory.address_register)
+            instruction_memory.read()
+
+        return {
+            InstructionMemorySignal.READ: read,
+            InstructionMemorySignal.SET_ADDRESS: set_address,
+        }
+
+    def ip_mux_signals(self) -> dict[Enum, Callable[[], None]]:
+        ip_mux = self.ip_mux
+        data_stack = self.data_stack
+        return_stack = self.return_stack
+        alu = self.alu
+
+        def ip():
+            ip_mux.mux_value = self.instruction_pointer + 1
+
+        def ds():
+            ip_mux.mux_value = data_stack.peek()
+
+        def rs():
+            ip_mux.mux_value = return_stack.peek()
+
+        def alu_result():
+            ip_mux.mux_value = alu.result
+
+        def operand():
+            ip_mux.mux_value = self.operand_register
+
+        return {
+            IpMuxSignal.IP: ip,
+            IpMuxSignal.DS: ds,
+            IpMuxSignal.RS: rs,
+            IpMuxSignal.ALU: alu_result,
+            IpMuxSignal.OPERAND: operand,
+        }
+
+    def ds_mux_signals(self) -> dict[Enum, Callable[[], None]]:
+        ds_mux = self.ds_mux
+        data_stack = self.data_stack
+        data_memory = self.data_memory
+        alu = self.alu
+
+        def ds():
+            ds_mux.mux_value = data_stack.peek()
+
+        def dm():
+            ds_mux.mux_value = data_memory.data_register
+
+        def alu_result():
+            ds_mux.mux_value = alu.result
+
+        def operand():
+            ds_mux.mux_value = self.operand_register
+
+        return {
+            DsMuxSignal.DS: ds,
+            DsMuxSignal.DM: dm,
+            DsMuxSignal.ALU: alu_result,
+            DsMuxSignal.OPERAND: operand,
+        }
+
+    def dm_mux_signals(self) -> dict[Enum, Callable[[], None]]:
+        dm_mux = self.dm_mux
+        data_stack = self.data_stack
+        alu = self.alu
+
+        def ds():
+            dm_mux.mux_value = data_stack.peek()
+
+        def alu_result():
+            dm_mux.mux_value = alu.result
+
+        def operand():
+            dm_mux.mux_value = self.operand_register
+
+        signals: dict[Enum, Callable[[], None]] = {
+            DmMuxSignal.DS: ds,
+            DmMuxSignal.ALU: alu_result,
+            DmMuxSignal.OPERAND: operand,
+        }
+
+        if isinstance(data_stack, TosStack):
+            tos_stack = data_stack
+
+            def nos():
+                dm_mux.mux_value = tos_stack.second()
+
+            signals[DmMuxSignal.NOS] = nos
+
+        return signals
+
+    def alu_mux_signals(self, mux: MUX, signals: type[AluMuxSignalA] | type[AluMuxSignalB]) -> dict[Enum, Callable[[], None]]:
+        data_stack = self.data_stack
+        alu = self.alu
+
+        def ds():
+            mux.mux_value = data_stack.peek()
+
+        def zero():
+            mux.mux_value = 0
+
+        def one():
+            mux.mux_value = 1
+
+        def alu_result():
+            mux.mux_value = alu.result
+
+        return {
+            signals.DS: ds,
+            signals.ZERO: zero,
+            signals.ONE: one,
+            signals.ALU: alu_result,
+        }
+
+    def alu_mux_a_signals(self) -> dict[Enum, Callable[[], None]]:
+        return self.alu_mux_signals(self.alu_mux_a, AluMuxSignalA)
+
+    def alu_mux_b_signals(self) -> dict[Enum, Callable[[], None]]:
+        return self.alu_mux_signals(self.alu_mux_b, AluMuxSignalB)
+
+    def latch_signals(self) -> dict[Enum, Callable[[], None]]:
+        ip_mux = self.ip_mux
+        instruction_memory = self.instruction_memory
+
+        def ip():
+            self.instruction_pointer = ip_mux.mux_value
+
+        def ir():
+            # the operand flag is a bit of the instruction word, so the operand is latched right away
+            # instead of going through the ALU
+            word = instruction_memory.data_register
+            self.instruction_register = opcodes[word >> OPCODE_SHIFT].value
+            self.operand_flag = 1 if word & OPERAND_FLAG else 0
+            self.operand_register = decode_operand(word) if self.operand_flag else 0
+
+        return {
+            LatchSignal.IP: ip,
+            LatchSignal.IR: ir,
+        }
+
+    def alu_signals(self) -> dict[Enum, Callable[[], None]]:
+        alu = self.alu
+        alu_mux_a = self.alu_mux_a
+        alu_mux_b = self.alu_mux_b
+
+        def set_a():
+            alu.a = alu_mux_a.mux_value
+
+        def set_b():
+            alu.b = alu_mux_b.mux_value
+
+        return {
+            AluSignal.ADD: alu.add,
+            AluSignal.SUB: alu.sub,
+            AluSignal.MUL: alu.mul,
+            AluSignal.DIV: alu.div,
+            AluSignal.MOD: alu.mod,
+            AluSignal.COMP: alu.compare,
+            AluSignal.EQUALS: alu.equals,
+            AluSignal.LESS: alu.less,
+            AluSignal.GREATER: alu.greater,
+            AluSignal.SET_A: set_a,
+            AluSignal.SET_B: set_b,
+            AluSignal.NOT_A: alu.not_a,
+            AluSignal.NOT_B: alu.not_b,
+        }
+
+    def jump_signals(self) -> dict[Enum, Callable[[], None]]:
+        data_stack = self.data_stack
+        ip_mux = self.ip_mux
+
+        def jmp():
+            self.instruction_pointer = ip_mux.mux_value
+
+        def jmz():
+            if data_stack.peek() == 0:
+                self.instruction_pointer = ip_mux.mux_value
+
+        def jnz():
+            if data_stack.peek() != 0:
+                self.instruction_pointer = ip_mux.mux_value
+
+        return {
+            JumpSignal.JMP: jmp,
+            JumpSignal.JMZ: jmz,
+            JumpSignal.JNZ: jnz,
+        }
+
+    def write_digits(self):
+        # the output device takes one character per tick, the first one fits into the WRITE signal tick
+        for digit in self.digit_buffer.digits:
+            self.output_device.write(digit)
+        self.stall_ticks += len(self.digit_buffer.digits) - 1
+
+    def print_number(self, value: int):
+        self.digit_buffer.load(value)
+        self.write_digits()
+
+    def digit_buffer_signals(self) -> dict[Enum, Callable[[], None]]:
+        data_stack = self.data_stack
+        digit_buffer = self.digit_buffer
+
+        def load():
+            digit_buffer.load(data_stack.peek())
+
+        return {
+            DigitBufferSignal.LOAD: load,
+            DigitBufferSignal.WRITE: self.write_digits,
+        }
+
+    def control_signals(self) -> dict[Enum, Callable[[], None]]:
+        def halt():
+            self.exit_flag = 1
+
+        def nop():
+            pass
+
+        return {
+            ControlSignal.HALT: halt,
+            ControlSignal.NOP: nop,
+        }
+
+
+# Microprograms replaced when the top of the data stack is kept in a register: the result of an instruction that
+# pops its last operand and pushes a value is written to the register in place, dup copies the register below itself
+tos_mcode: dict[str, list[Enum]] = {
+    "add": [AluMuxSignalB.DS, AluSignal.SET_B, DataStackSignal.POP, AluMuxSignalA.DS, AluSignal.SET_A, AluSignal.ADD, DsMuxSignal.ALU, DataStackSignal.REPLACE],
+    "sub": [AluMuxSignalB.DS, AluSignal.SET_B, DataStackSignal.POP, AluMuxSignalA.DS, AluSignal.SET_A, AluSignal.SUB, DsMuxSignal.ALU, DataStackSignal.REPLACE],
+    "mul": [AluMuxSignalB.DS, AluSignal.SET_B, DataStackSignal.POP, AluMuxSignalA.DS, AluSignal.SET_A, AluSignal.MUL, DsMuxSignal.ALU, DataStackSignal.REPLACE],
+    "div": [AluMuxSignalB.DS, AluSignal.SET_B, DataStackSignal.POP, AluMuxSignalA.DS, AluSignal.SET_A, AluSignal.DIV, DsMuxSignal.ALU, DataStackSignal.REPLACE],
+    "mod": [AluMuxSignalB.DS, AluSignal.SET_B, DataStackSignal.POP, AluMuxSignalA.DS, AluSignal.SET_A, AluSignal.MOD, DsMuxSignal.ALU, DataStackSignal.REPLACE],
+    "eql": [AluMuxSignalB.DS, AluSignal.SET_B, DataStackSignal.POP, AluMuxSignalA.DS, AluSignal.SET_A, AluSignal.EQUALS, DsMuxSignal.ALU, DataStackSignal.REPLACE],
+    "less": [AluMuxSignalB.DS, AluSignal.SET_B, DataStackSignal.POP, AluMuxSignalA.DS, AluSignal.SET_A, AluSignal.LESS, DsMuxSignal.ALU, DataStackSignal.REPLACE],
+    "lrg": [AluMuxSignalB.DS, AluSignal.SET_B, DataStackSignal.POP, AluMuxSignalA.DS, AluSignal.SET_A, AluSignal.GREATER, DsMuxSignal.ALU, DataStackSignal.REPLACE],
+    "comp": [AluMuxSignalB.DS, AluSignal.SET_B, DataStackSignal.POP, AluMuxSignalA.DS, AluSignal.SET_A, AluSignal.COMP, DsMuxSignal.ALU, DataStackSignal.REPLACE],
+    "inc": [AluMuxSignalB.ONE, AluSignal.SET_B, AluMuxSignalA.DS, AluSignal.SET_A, AluSignal.ADD, DsMuxSignal.ALU, DataStackSignal.REPLACE],
+    "dec": [AluMuxSignalB.ONE, AluSignal.SET_B, AluMuxSignalA.DS, AluSignal.SET_A, AluSignal.SUB, DsMuxSignal.ALU, DataStackSignal.REPLACE],
+    "not": [AluMuxSignalB.ZERO, AluSignal.SET_B, AluMuxSignalA.DS, AluSignal.SET_A, AluSignal.NOT_A, DsMuxSignal.ALU, DataStackSignal.REPLACE],
+    "read": [DmMuxSignal.DS, DataMemorySignal.SET_ADDRESS, DataMemorySignal.READ, DsMuxSignal.DM, DataStackSignal.REPLACE],
+    "dup": [DataStackSignal.SPILL],
+    "save": [DmMuxSignal.DS, DataMemorySignal.SET_ADDRESS, DmMuxSignal.NOS, DataMemorySignal.WRITE, DataStackSignal.POP_TWO],
+}
+
+
+# Resources every signal reads and drives. Mux outputs are wires: a wire is only valid in the tick that drives it.
+# Everything else is a register latched at the end of the tick, so a value written in a tick is seen in the next one.
+wires = {"ip_mux", "ds_mux", "dm_mux", "alu_mux_a", "alu_mux_b"}
+
+alu_operation = ({"alu_a", "alu_b"}, {"alu_result"})
+
+signal_resources: dict[Enum, tuple[set[str], set[str]]] = {
+    ReturnStackSignal.PUSH: ({"ip", "rs"}, {"rs"}),
+    ReturnStackSignal.POP: ({"rs"}, {"rs"}),
+    DataStackSignal.PUSH: ({"ds_mux", "ds"}, {"ds"}),
+    DataStackSignal.POP: ({"ds"}, {"ds"}),
+    DataStackSignal.SWAP: ({"ds"}, {"ds"}),
+    DataStackSignal.REPLACE: ({"ds_mux", "ds"}, {"ds"}),
+    DataStackSignal.SPILL: ({"ds"}, {"ds"}),
+    DataStackSignal.POP_TWO: ({"ds"}, {"ds"}),
+    DataMemorySignal.WRITE: ({"dm_ar", "dm_mux"}, {"dm", "output"}),
+    DataMemorySignal.READ: ({"dm_ar", "dm", "input"}, {"dm_dr", "input"}),
+    DataMemorySignal.SET_ADDRESS: ({"dm_mux"}, {"dm_ar"}),
+    InstructionMemorySignal.READ: ({"im_ar"}, {"im_dr"}),
+    InstructionMemorySignal.SET_ADDRESS: ({"ip"}, {"im_ar"}),
+    LatchSignal.IP: ({"ip_mux"}, {"ip"}),
+    LatchSignal.IR: ({"im_dr"}, {"ir", "operand_flag", "operand"}),
+    IpMuxSignal.IP: ({"ip"}, {"ip_mux"}),
+    IpMuxSignal.DS: ({"ds"}, {"ip_mux"}),
+    IpMuxSignal.RS: ({"rs"}, {"ip_mux"}),
+    IpMuxSignal.ALU: ({"alu_result"}, {"ip_mux"}),
+    IpMuxSignal.OPERAND: ({"operand"}, {"ip_mux"}),
+    DsMuxSignal.DS: ({"ds"}, {"ds_mux"}),
+    DsMuxSignal.DM: ({"dm_dr"}, {"ds_mux"}),
+    DsMuxSignal.ALU: ({"alu_result"}, {"ds_mux"}),
+    DsMuxSignal.OPERAND: ({"operand"}, {"ds_mux"}),
+    DmMuxSignal.DS: ({"ds"}, {"dm_mux"}),
+    DmMuxSignal.ALU: ({"alu_result"}, {"dm_mux"}),
+    DmMuxSignal.OPERAND: ({"operand"}, {"dm_mux"}),
+    DmMuxSignal.NOS: ({"ds"}, {"dm_mux"}),
+    **{signal: alu_operation for signal in AluSignal if signal not in (AluSignal.SET_A, AluSignal.SET_B)},
+    AluSignal.SET_A: ({"alu_mux_a"}, {"alu_a"}),
+    AluSignal.SET_B: ({"alu_mux_b"}, {"alu_b"}),
+    AluMuxSignalA.DS: ({"ds"}, {"alu_mux_a"}),
+    AluMuxSignalA.ALU: ({"alu_result"}, {"alu_mux_a"}),
+    AluMuxSignalA.ZERO: (set(), {"alu_mux_a"}),
+    AluMuxSignalA.ONE: (set(), {"alu_mux_a"}),
+    AluMuxSignalB.DS: ({"ds"}, {"alu_mux_b"}),
+    AluMuxSignalB.ALU: ({"alu_result"}, {"alu_mux_b"}),
+    AluMuxSignalB.ZERO: (set(), {"alu_mux_b"}),
+    AluMuxSignalB.ONE: (set(), {"alu_mux_b"}),
+    JumpSignal.JMP: ({"ip_mux"}, {"ip"}),
+    JumpSignal.JMZ: ({"ip_mux", "ds"}, {"ip"}),
+    JumpSignal.JNZ: ({"ip_mux", "ds"}, {"ip"}),
+    DigitBufferSignal.LOAD: ({"ds"}, {"digits"}),
+    DigitBufferSignal.WRITE: ({"digits"}, {"output"}),
+    ControlSignal.HALT: (set(), {"exit"}),
+    ControlSignal.NOP: (set(), set()),
+}
+
+
+def conflict(microinstruction: list[Enum]) -> str | None:
+    driven: set[str] = set()
+    for signal in microinstruction:
+        reads, writes = signal_resources[signal]
+        for resource in reads:
+            if resource in wires and resource not in driven:
+                return f"{signal} uses {resource} before it is driven"
+            if resource not in wires and resource in driven:
+                return f"{signal} reads {resource} latched in the same tick"
+        for resource in writes & driven:
+            return f"{signal} drives {resource} driven by another signal"
+        driven |= writes
+    return None
+
+
+def check_microinstruction(microinstruction: list[Enum]):
+    reason = conflict(microinstruction)
+    assert reason is None, f"conflicting signals {microinstruction}: {reason}"
+
+
+def pack_microcode(mcode: list[Enum]) -> list[list[Enum]]:
+    # Greedy in program order: a signal joins the current microinstruction unless it conflicts with it.
+    # Signals of a microinstruction still run in program order, so the result is the same as one signal per tick.
+    microinstructions: list[list[Enum]] = []
+    for signal in mcode:
+        if microinstructions and conflict(microinstructions[-1] + [signal]) is None:
+            microinstructions[-1].append(signal)
+        else:
+            microinstructions.append([signal])
+            check_microinstruction(microinstructions[-1])
+    return microinstructions
 
 
 class ControlUnit:
-    def __init__(self, data_path: DataPath):
+    def __init__(self, data_path: DataPath, tracer: Tracer | None = None, horizontal: bool = False):
         self.data_path = data_path
+        self.tracer = tracer if tracer is not None else Tracer()
+        # horizontal control: independent signals of a microprogram fire in the same tick
+        self.horizontal = horizontal
 
         self.instruction_counter: int = 0
         self.ticks = 0
 
-        self.no_operand_mcode = {
-            "fetch": [InstructionMemorySignal.SET_ADDRESS, InstructionMemorySignal.READ, LatchSignal.IR, AluMuxSignalA.IM, AluSignal.SET_A, AluMuxSignalB.ZERO, AluSignal.SET_B, AluSignal.ADD, IpMuxSignal.IP, LatchSignal.IP],
+        self.no_operand_mcode: dict[str, list[Enum]] = {
+            "fetch": [InstructionMemorySignal.SET_ADDRESS, InstructionMemorySignal.READ, LatchSignal.IR, IpMuxSignal.IP, LatchSignal.IP],
             "add": [AluMuxSignalB.DS, AluSignal.SET_B, DataStackSignal.POP, AluMuxSignalA.DS, AluSignal.SET_A, DataStackSignal.POP, AluSignal.ADD, DsMuxSignal.ALU, DataStackSignal.PUSH],
             "sub": [AluMuxSignalB.DS, AluSignal.SET_B, DataStackSignal.POP, AluMuxSignalA.DS, AluSignal.SET_A, DataStackSignal.POP, AluSignal.SUB, DsMuxSignal.ALU, DataStackSignal.PUSH],
             "mul": [AluMuxSignalB.DS, AluSignal.SET_B, DataStackSignal.POP, AluMuxSignalA.DS, AluSignal.SET_A, DataStackSignal.POP, AluSignal.MUL, DsMuxSignal.ALU, DataStackSignal.PUSH],
@@ -336,81 +632,641 @@ class ControlUnit:
             "read": [DmMuxSignal.DS, DataMemorySignal.SET_ADDRESS, DataStackSignal.POP, DataMemorySignal.READ, DsMuxSignal.DM, DataStackSignal.PUSH],
             "save": [DmMuxSignal.DS, DataMemorySignal.SET_ADDRESS, DataStackSignal.POP, DmMuxSignal.DS, DataMemorySignal.WRITE, DataStackSignal.POP],
             "swap": [DataStackSignal.SWAP],
+            "print": [DigitBufferSignal.LOAD, DataStackSignal.POP, DigitBufferSignal.WRITE],
             "hlt": [ControlSignal.HALT],
             "nop": [ControlSignal.NOP]
         }
 
-        self.one_operand_mcode = {
-            "push": [DsMuxSignal.ALU, DataStackSignal.PUSH],
-            "read": [DmMuxSignal.ALU, DataMemorySignal.SET_ADDRESS, DataMemorySignal.READ, DsMuxSignal.DM, DataStackSignal.PUSH],
-            "save": [DmMuxSignal.ALU, DataMemorySignal.SET_ADDRESS, DmMuxSignal.DS, DataMemorySignal.WRITE, DataStackSignal.POP],
-            "jmp": [IpMuxSignal.ALU, JumpSignal.JMP],
-            "jmz": [IpMuxSignal.ALU, JumpSignal.JMZ, DataStackSignal.POP],
-            "jnz": [IpMuxSignal.ALU, JumpSignal.JNZ, DataStackSignal.POP],
+        self.one_operand_mcode: dict[str, list[Enum]] = {
+            "push": [DsMuxSignal.OPERAND, DataStackSignal.PUSH],
+            "read": [DmMuxSignal.OPERAND, DataMemorySignal.SET_ADDRESS, DataMemorySignal.READ, DsMuxSignal.DM, DataStackSignal.PUSH],
+            "save": [DmMuxSignal.OPERAND, DataMemorySignal.SET_ADDRESS, DmMuxSignal.DS, DataMemorySignal.WRITE, DataStackSignal.POP],
+            "jmp": [IpMuxSignal.OPERAND, JumpSignal.JMP],
+            "jmz": [IpMuxSignal.OPERAND, JumpSignal.JMZ, DataStackSignal.POP],
+            "jnz": [IpMuxSignal.OPERAND, JumpSignal.JNZ, DataStackSignal.POP],
+            "call": [IpMuxSignal.OPERAND, ReturnStackSignal.PUSH, JumpSignal.JMP],
         }
 
+        if isinstance(data_path.data_stack, TosStack):
+            self.no_operand_mcode.update(tos_mcode)
+
+        self.fetch_program = self.compile(self.no_operand_mcode["fetch"])
+        self.no_operand_programs = {name: self.compile(mcode) for name, mcode in self.no_operand_mcode.items()}
+        self.one_operand_programs = {name: self.compile(mcode) for name, mcode in self.one_operand_mcode.items()}
+
+    def microinstructions(self, mcode: list[Enum]) -> list[list[Enum]]:
+        return pack_microcode(mcode) if self.horizontal else [[mc] for mc in mcode]
+
+    def compile(self, mcode: list[Enum]) -> Callable[[], None]:
+        steps = tuple(self.data_path.signals[mc] for mc in mcode)
+        length = len(self.microinstructions(mcode))
+
+        def program():
+            for step in steps:
+                step()
+            self.ticks += length
+
+        return program
+
     def tick(self):
         self.ticks += 1
 
-    def handle_command(self):
-        logging.debug(f"Fetching instruction id = {self.data_path.instruction_pointer}")
-        for mc in self.no_operand_mcode["fetch"]:
-            logging.debug(f"Processing mcode instruction {mc}")
-            self.data_path.handle_signal[type(mc)](mc)
+    def stall(self):
+        self.ticks += self.data_path.stall_ticks
+        self.data_path.stall_ticks = 0
+
+    def execute_traced(self, mcode: list[Enum], state: bool = True):
+        data_path = self.data_path
+        for microinstruction in self.microinstructions(mcode):
+            for mc in microinstruction:
+                self.tracer.signal(mc)
+                data_path.signals[mc]()
             self.tick()
+            if state:
+                self.tracer.state(data_path.data_stack, data_path.return_stack, data_path.output_buffer, data_path.alu)
 
-        logging.debug(f"Instruction n = {self.instruction_counter}: {self.data_path.instruction_register}")
+    def instruction_ticks(self, opcode: str, has_operand: bool) -> int:
+        mcode = self.one_operand_mcode[opcode] if has_operand else self.no_operand_mcode[opcode]
+        return len(self.microinstructions(self.no_operand_mcode["fetch"])) + len(self.microinstructions(mcode))
 
-        if self.data_path.operand_flag:
-            logging.debug(f"Has operand {self.data_path.alu.result}")
-            for mc in self.one_operand_mcode[self.data_path.instruction_register]:
-                logging.debug(f"Processing mcode instruction {mc}")
-                self.data_path.handle_signal[type(mc)](mc)
-                self.tick()
-                logging.debug(f"DS: {self.data_path.data_stack} RS: {self.data_path.return_stack} OutBuffer: {self.data_path.output_buffer} ALU: res = {self.data_path.alu.result}, a = {self.data_path.alu.a}, b = {self.data_path.alu.b}")
-        else:
-            logging.debug("Has no operand")
-            for mc in self.no_operand_mcode[self.data_path.instruction_register]:
-                logging.debug(f"Processing mcode instruction {mc}")
-                self.data_path.handle_signal[type(mc)](mc)
-                self.tick()
-                logging.debug(f"DS: {self.data_path.data_stack} RS: {self.data_path.return_stack} OutBuffer: {self.data_path.output_buffer} ALU: res = {self.data_path.alu.result}, a = {self.data_path.alu.a}, b = {self.data_path.alu.b}")
+    def run(self):
+        while self.data_path.exit_flag != 1:
+            self.handle_command()
+            self.instruction_counter += 1
+        self.stall()
+
+    def handle_command(self):
+        data_path = self.data_path
+        match self.tracer.level:
+            case TraceLevel.OFF:
+                self.fetch_program()
+                if data_path.operand_flag:
+                    self.one_operand_programs[data_path.instruction_register]()
+                else:
+                    self.no_operand_programs[data_path.instruction_register]()
+            case TraceLevel.INSTRUCTION:
+                self.tracer.fetch(data_path.instruction_pointer)
+                self.fetch_program()
+                self.tracer.decoded(self.instruction_counter, data_path.instruction_register)
+                self.tracer.operand(data_path.operand_flag, data_path.operand_register)
+                if data_path.operand_flag:
+                    self.one_operand_programs[data_path.instruction_register]()
+                else:
+                    self.no_operand_programs[data_path.instruction_register]()
+                self.tracer.state(data_path.data_stack, data_path.return_stack, data_path.output_buffer, data_path.alu)
+            case TraceLevel.MICROCODE:
+                self.tracer.fetch(data_path.instruction_pointer)
+                self.execute_traced(self.no_operand_mcode["fetch"], state=False)
+                self.tracer.decoded(self.instruction_counter, data_path.instruction_register)
+                self.tracer.operand(data_path.operand_flag, data_path.operand_register)
+                if data_path.operand_flag:
+                    self.execute_traced(self.one_operand_mcode[data_path.instruction_register])
+                else:
+                    self.execute_traced(self.no_operand_mcode[data_path.instruction_register])
+
+
+def tos_tick_reduction(horizontal: bool = False) -> dict[str, tuple[int, int]]:
+    # execution ticks of the instructions the TOS register changes, without it and with it, in the active microcode
+    stack_unit = ControlUnit(DataPath(), horizontal=horizontal)
+    tos_unit = ControlUnit(DataPath(data_stack=TosStack()), horizontal=horizontal)
+    return {name: (len(stack_unit.microinstructions(stack_unit.no_operand_mcode[name])),
+                   len(tos_unit.microinstructions(tos_unit.no_operand_mcode[name]))) for name in tos_mcode}
+
+
+# handler, operand, ticks, opcode
+DecodedInstruction = tuple[Callable[[int | None], None], int | None, int, str]
+
+
+class InstructionEngine(ControlUnit):
+    # Executes whole instructions on the stacks and memories instead of stepping through signals.
+    # Every instruction is charged the length of its fetch and execution microprograms,
+    # so ticks and instruction_counter match the microcode engine exactly.
+    def __init__(self, data_path: DataPath, tracer: Tracer | None = None, horizontal: bool = False):
+        super().__init__(data_path, tracer, horizontal)
+
+        self.no_operand_handlers = self.build_no_operand_handlers()
+        self.one_operand_handlers = self.build_one_operand_handlers()
+
+    def build_no_operand_handlers(self) -> dict[str, Callable[[int | None], None]]:
+        data_path = self.data_path
+        data_stack = data_path.data_stack
+        return_stack = data_path.return_stack
+
+        def binary(operation: Callable[[int, int], int]) -> Callable[[int | None], None]:
+            def handler(_operand):
+                b = data_stack.pop()
+                a = data_stack.pop()
+                data_stack.push(operation(a, b))
+
+            return handler
+
+        def unary(operation: Callable[[int], int]) -> Callable[[int | None], None]:
+            def handler(_operand):
+                data_stack.push(operation(data_stack.pop()))
+
+            return handler
+
+        def pop(_operand):
+            data_stack.pop()
+
+        def dup(_operand):
+            data_stack.push(data_stack.peek())
+
+        def swap(_operand):
+            data_stack.swap()
+
+        def ret(_operand):
+            data_path.instruction_pointer = return_stack.pop()
+
+        def read(_operand):
+            data_stack.push(data_path.load(data_stack.pop()))
+
+        def save(_operand):
+            address = data_stack.pop()
+            data_path.store(address, data_stack.pop())
+
+        def print_number(_operand):
+            data_path.print_number(data_stack.pop())
+
+        def hlt(_operand):
+            data_path.exit_flag = 1
+
+        def nop(_operand):
+            pass
+
+        return {
+            "add": binary(lambda a, b: a + b),
+            "sub": binary(lambda a, b: a - b),
+            "mul": binary(lambda a, b: a * b),
+            "div": binary(lambda a, b: a // b),
+            "mod": binary(lambda a, b: a % b),
+            "eql": binary(lambda a, b: -1 if a == b else 0),
+            "less": binary(lambda a, b: -1 if a < b else 0),
+            "lrg": binary(lambda a, b: -1 if a > b else 0),
+            "comp": binary(lambda a, b: 1 if a > b else -1 if a < b else 0),
+            "inc": unary(lambda a: a + 1),
+            "dec": unary(lambda a: a - 1),
+            "not": unary(lambda a: int(not a)),
+            "pop": pop,
+            "dup": dup,
+            "swap": swap,
+            "ret": ret,
+            "read": read,
+            "save": save,
+            "print": print_number,
+            "hlt": hlt,
+            "nop": nop,
+        }
+
+    def build_one_operand_handlers(self) -> dict[str, Callable[[int | None], None]]:
+        data_path = self.data_path
+        data_stack = data_path.data_stack
+        return_stack = data_path.return_stack
+
+        def push(operand):
+            data_stack.push(operand)
+
+        def read(operand):
+            data_stack.push(data_path.load(operand))
+
+        def save(operand):
+            data_path.store(operand, data_stack.pop())
+
+        def jmp(operand):
+            data_path.instruction_pointer = operand
+
+        def jmz(operand):
+            if data_stack.pop() == 0:
+                data_path.instruction_pointer = operand
 
+        def jnz(operand):
+            if data_stack.pop() != 0:
+                data_path.instruction_pointer = operand
 
-def simulate(source_path: str, input_path: str, result_path: str):
-    data_path = DataPath()
-    control_unit = ControlUnit(data_path)
+        def call(operand):
+            return_stack.push(data_path.instruction_pointer)
+            data_path.instruction_pointer = operand
+
+        return {
+            "push": push,
+            "read": read,
+            "save": save,
+            "jmp": jmp,
+            "jmz": jmz,
+            "jnz": jnz,
+            "call": call,
+        }
+
+    def decode(self) -> list[DecodedInstruction]:
+        instruction_memory = self.data_path.instruction_memory
+        program: list[DecodedInstruction] = []
+        for address in range(instruction_memory.get_last_allocated()):
+            instruction_memory.address_register = address
+            instruction = decode(instruction_memory.read())
+            opcode = instruction.opcode.value
+            if isinstance(instruction.operand, int):
+                handler = self.one_operand_handlers[opcode]
+                program.append((handler, instruction.operand, self.instruction_ticks(opcode, True), opcode))
+            else:
+                handler = self.no_operand_handlers[opcode]
+                program.append((handler, None, self.instruction_ticks(opcode, False), opcode))
+        return program
+
+    def run(self):
+        program = self.decode()
+        data_path = self.data_path
+
+        if self.tracer.level is not TraceLevel.OFF:
+            self.run_traced(program)
+            return
+        if data_path.instruction_cache is not None:
+            self.run_cached(program)
+            return
+
+        ticks = 0
+        counter = 0
+        while data_path.exit_flag != 1:
+            handler, operand, cost, _ = program[data_path.instruction_pointer]
+            data_path.instruction_pointer += 1
+            handler(operand)
+            ticks += cost
+            counter += 1
+
+        self.ticks += ticks
+        self.instruction_counter += counter
+        self.stall()
+
+    def run_cached(self, program: list[DecodedInstruction]):
+        data_path = self.data_path
+        instruction_cache = data_path.instruction_cache
+        assert instruction_cache is not None
+
+        ticks = 0
+        counter = 0
+        while data_path.exit_flag != 1:
+            handler, operand, cost, _ = program[data_path.instruction_pointer]
+            ticks += instruction_cache.read(data_path.instruction_pointer)
+            data_path.instruction_pointer += 1
+            handler(operand)
+            ticks += cost
+            counter += 1
+
+        self.ticks += ticks
+        self.instruction_counter += counter
+        self.stall()
+
+    def run_traced(self, program: list[DecodedInstruction]):
+        data_path = self.data_path
+        instruction_cache = data_path.instruction_cache
+        while data_path.exit_flag != 1:
+            handler, operand, cost, opcode = program[data_path.instruction_pointer]
+            if instruction_cache is not None:
+                self.ticks += instruction_cache.read(data_path.instruction_pointer)
+            self.tracer.fetch(data_path.instruction_pointer)
+            self.tracer.decoded(self.instruction_counter, opcode)
+            self.tracer.operand(int(operand is not None), operand)
+            data_path.instruction_pointer += 1
+            handler(operand)
+            self.ticks += cost
+            self.instruction_counter += 1
+            self.tracer.state(data_path.data_stack, data_path.return_stack, data_path.output_buffer, data_path.alu)
+        self.stall()
+
+
+class BlockEngine(InstructionEngine):
+    # Splits instruction memory into basic blocks and compiles each block into a Python function
+    # the first time control reaches it. Values produced and consumed inside a block stay in locals,
+    # only the remainder is pushed to the data stack when the block is left.
+    terminators = {"jmp", "jmz", "jnz", "call", "ret", "hlt"}
+
+    binary_expressions = {
+        "add": "{a} + {b}",
+        "sub": "{a} - {b}",
+        "mul": "{a} * {b}",
+        "div": "{a} // {b}",
+        "mod": "{a} % {b}",
+        "eql": "-1 if {a} == {b} else 0",
+        "less": "-1 if {a} < {b} else 0",
+        "lrg": "-1 if {a} > {b} else 0",
+        "comp": "1 if {a} > {b} else -1 if {a} < {b} else 0",
+    }
+
+    unary_expressions = {
+        "inc": "{a} + 1",
+        "dec": "{a} - 1",
+        "not": "int(not {a})",
+    }
+
+    def __init__(self, data_path: DataPath, tracer: Tracer | None = None, horizontal: bool = False):
+        super().__init__(data_path, tracer, horizontal)
+
+        self.blocks: dict[int, tuple[Callable[[], int], int, int]] = {}
+        self.sources: dict[int, str] = {}
+
+        self.namespace: dict[str, Any] = {
+            "ds_push": data_path.data_stack.push,
+            "ds_pop": data_path.data_stack.pop,
+            "ds_peek": data_path.data_stack.peek,
+            "rs_push": data_path.return_stack.push,
+            "rs_pop": data_path.return_stack.pop,
+            "load": data_path.load,
+            "store": data_path.store,
+            "print_number": data_path.print_number,
+            "data_path": data_path,
+        }
+
+    def leaders(self, program: list[DecodedInstruction]) -> set[int]:
+        leaders = {0}
+        for address, (_, operand, _, opcode) in enumerate(program):
+            if opcode in self.terminators:
+                leaders.add(address + 1)
+                if operand is not None:
+                    leaders.add(operand)
+        return leaders
+
+    def generate_block(self, program: list[DecodedInstruction],
+                       leaders: set[int], start: int) -> tuple[str, int, int]:
+        lines: list[str] = []
+        stack: list[str] = []
+        temporaries = 0
+
+        def temporary() -> str:
+            nonlocal temporaries
+            temporaries += 1
+            return f"t{temporaries}"
+
+        def need(count: int):
+            while len(stack) < count:
+                name = temporary()
+                lines.append(f"{name} = ds_pop()")
+                stack.insert(0, name)
+
+        def assign(expression: str):
+            name = temporary()
+            lines.append(f"{name} = {expression}")
+            stack.append(name)
+
+        def flush():
+            for value in stack:
+                lines.append(f"ds_push({value})")
+            stack.clear()
+
+        ticks = 0
+        address = start
+        while True:
+            _, operand, cost, opcode = program[address]
+            ticks += cost
+            address += 1
+
+            if operand is None and opcode in self.binary_expressions:
+                need(2)
+                b = stack.pop()
+                a = stack.pop()
+                assign(self.binary_expressions[opcode].format(a=a, b=b))
+            elif operand is None and opcode in self.unary_expressions:
+                need(1)
+                assign(self.unary_expressions[opcode].format(a=stack.pop()))
+            elif opcode == "push":
+                stack.append(repr(operand))
+            elif opcode == "pop":
+                if stack:
+                    stack.pop()
+                else:
+                    lines.append("ds_pop()")
+            elif opcode == "dup":
+                if not stack:
+                    assign("ds_peek()")
+                else:
+                    stack.append(stack[-1])
+            elif opcode == "swap":
+                need(2)
+                stack[-1], stack[-2] = stack[-2], stack[-1]
+            elif opcode == "read":
+                if operand is None:
+                    need(1)
+                    assign(f"load({stack.pop()})")
+                else:
+                    assign(f"load({operand})")
+            elif opcode == "save":
+                if operand is None:
+                    need(2)
+                    target = stack.pop()
+                    lines.append(f"store({target}, {stack.pop()})")
+                else:
+                    need(1)
+                    lines.append(f"store({operand}, {stack.pop()})")
+            elif opcode == "print":
+                need(1)
+                lines.append(f"print_number({stack.pop()})")
+            elif opcode == "jmp":
+                flush()
+                lines.append(f"return {operand}")
+            elif opcode == "call":
+                flush()
+                lines.append(f"rs_push({address})")
+                lines.append(f"return {operand}")
+            elif opcode in ("jmz", "jnz"):
+                need(1)
+                condition = stack.pop()
+                flush()
+                lines.append(f"if {condition} {'==' if opcode == 'jmz' else '!='} 0:")
+                lines.append(f"    return {operand}")
+                lines.append(f"return {address}")
+            elif opcode == "ret":
+                flush()
+                lines.append("return rs_pop()")
+            elif opcode == "hlt":
+                flush()
+                lines.append("data_path.exit_flag = 1")
+                lines.append(f"return {address}")
+            elif opcode != "nop":
+                assert False, f"unknown instruction {opcode} at {address - 1}"
+
+            if opcode in self.terminators:
+                break
+            if address in leaders or address == len(program):
+                flush()
+                lines.append(f"return {address}")
+                break
+
+        source = f"def block_{start}():\n" + "".join(f"    {line}\n" for line in lines)
+        return source, ticks, address - start
+
+    def compile_block(self, program: list[DecodedInstruction],
+                      leaders: set[int], start: int) -> tuple[Callable[[], int], int, int]:
+        source, ticks, length = self.generate_block(program, leaders, start)
+        exec(compile(source, f"<block {start}>", "exec"), self.namespace)
+
+        self.sources[start] = source
+        self.blocks[start] = (self.namespace[f"block_{start}"], ticks, length)
+        return self.blocks[start]
+
+    def run(self):
+        if self.tracer.level is not TraceLevel.OFF:
+            super().run()
+            return
+
+        program = self.decode()
+        leaders = self.leaders(program)
+        data_path = self.data_path
+        blocks = self.blocks
+
+        instruction_cache = data_path.instruction_cache
+
+        ticks = 0
+        counter = 0
+        instruction_pointer = data_path.instruction_pointer
+        while data_path.exit_flag != 1:
+            block = blocks.get(instruction_pointer)
+            if block is None:
+                block = self.compile_block(program, leaders, instruction_pointer)
+            function, cost, length = block
+            if instruction_cache is not None:
+                # a block always runs to its end, so its fetches are known in advance
+                for address in range(instruction_pointer, instruction_pointer + length):
+                    ticks += instruction_cache.read(address)
+            instruction_pointer = function()
+            ticks += cost
+            counter += length
+
+        data_path.instruction_pointer = instruction_pointer
+        self.ticks += ticks
+        self.instruction_counter += counter
+        self.stall()
+
+
+class Engine(Enum):
+    MICROCODE = "microcode"
+    INSTRUCTION = "instruction"
+    JIT = "jit"
+
+    def __str__(self):
+        return self.value
+
+
+engines: dict[Engine, type[ControlUnit]] = {
+    Engine.MICROCODE: ControlUnit,
+    Engine.INSTRUCTION: InstructionEngine,
+    Engine.JIT: BlockEngine,
+}
+
+
+def open_input(input_path: str) -> ContextManager[TextIO]:
+    if input_path == "-":
+        return contextlib.nullcontext(sys.stdin)
+    return open(input_path, "r")
+
+
+def open_output(result_path: str) -> ContextManager[TextIO]:
+    if result_path == "-":
+        return contextlib.nullcontext(sys.stdout)
+    return open(result_path, "w")
+
+
+# data memory layout, instruction words and labels of a translated program
+Program = tuple[list[tuple[int, int]], Sequence[int], dict[str, int]]
+
+
+def load_program(source_path: str) -> Program:
+    if is_object_file(source_path):
+        return read_object(source_path)
 
     with open(source_path, "r") as source_file:
         source = json.load(source_file)
 
-    with open(input_path, "r") as input_file:
-        data_path.input_buffer = list(map(ord, list(input_file.read()))) + [0]
+    memory = [(variable["idx"], variable["size"]) for variable in source["memory"]]
+    instructions: list[int] = []
+    for instruction in source["instructions"]:
+        assert instruction["idx"] == len(instructions), f"instruction {instruction['idx']} is out of order"
+        instructions.append(encode(OpCode(instruction["opcode"]), instruction.get("operand")))
+    labels = {label["name"]: label["idx"] for label in source.get("labels", [])}
+
+    return memory, instructions, labels
+
+
+def simulate(source_path: str, input_path: str, result_path: str, trace_level: TraceLevel | None = None,
+             engine: Engine = Engine.MICROCODE, data_memory: str = "dict", instruction_memory: str = "dict",
+             keep_output: bool = True, data_stack_size: int | None = None,
+             return_stack_size: int | None = None, data_cache: str | None = None,
+             instruction_cache: str | None = None, tos_register: bool = False,
+             horizontal: bool = False, program: Program | None = None) -> ControlUnit:
+    # program is the image of source_path loaded beforehand, to share it between runs
+    tracer = Tracer.from_logging() if trace_level is None else Tracer(trace_level)
 
-    for variable in source["memory"]:
-        data_path.data_memory.allocate(variable["size"])
-        data_path.data_memory.address_register = variable["idx"]
+    data_stack = FixedStack(data_stack_size) if data_stack_size is not None else Stack()
+    return_stack = FixedStack(return_stack_size) if return_stack_size is not None else Stack()
+    if tos_register:
+        data_stack = TosStack(data_stack)
+
+    data_path = DataPath(memory_models[data_memory](), memory_models[instruction_memory](), data_stack, return_stack,
+                         parse_cache(data_cache) if data_cache is not None else None,
+                         parse_cache(instruction_cache) if instruction_cache is not None else None)
+    control_unit = engines[engine](data_path, tracer, horizontal)
+
+    memory, instructions, labels = program if program is not None else load_program(source_path)
+
+    for idx, size in memory:
+        data_path.data_memory.allocate(size)
+        data_path.data_memory.address_register = idx
         data_path.data_memory.write(0)
 
-    for instruction in source["instructions"]:
-        data_path.instruction_memory.allocate(1)
-        data_path.instruction_memory.address_register = instruction["idx"]
-        data_path.instruction_memory.write(instruction)
+    data_path.instruction_memory.load(instructions)
 
-    while data_path.exit_flag != 1:
-        control_unit.handle_command()
-        control_unit.instruction_counter += 1
+    with open_input(input_path) as input_file, open_output(result_path) as result_file:
+        data_path.input_device = InputDevice(input_file)
+        data_path.output_device = OutputDevice(result_file, keep_copy=keep_output or tracer.level is not TraceLevel.OFF)
+        try:
+            control_unit.run()
+        finally:
+            data_path.output_device.flush()
 
-    logging.info(f"System time: {control_unit.ticks}, instructions: {control_unit.instruction_counter}, output buffer: {data_path.output_buffer}")
+    tracer.summary(control_unit.ticks, control_unit.instruction_counter, data_path.output_buffer)
+    tracer.stack_usage(data_path.data_stack, data_path.return_stack)
+    if tos_register:
+        tracer.tos_usage(tos_tick_reduction(horizontal))
+    if data_path.data_cache is not None:
+        tracer.cache_usage("Data cache", data_path.data_cache)
+    if data_path.instruction_cache is not None:
+        tracer.cache_usage("Instruction cache", data_path.instruction_cache)
+        tracer.label_misses("Instruction cache", misses_by_label(data_path.instruction_cache, labels))
 
-    with open(result_path, "w") as result_file:
-        for c in data_path.output_buffer:
-            if c != 0:
-                result_file.write(chr(c))
+    return control_unit
 
 
 if __name__ == "__main__":
-    assert len(sys.argv) == 3, "Usage: python machine.py <source> <input> <target>"
-    logging.basicConfig(level=logging.DEBUG, handlers=[logging.StreamHandler()], encoding="utf-8")
-    simulate(sys.argv[1], sys.argv[2], sys.argv[3])
+    parser = argparse.ArgumentParser(description="Simulate a translated program")
+    parser.add_argument("source")
+    parser.add_argument("input", help="input file, '-' reads from stdin")
+    parser.add_argument("target", help="output file, '-' writes to stdout")
+    parser.add_argument("--trace", type=TraceLevel, choices=list(TraceLevel), default=TraceLevel.OFF,
+                        help="off: summary only, instruction: one record per instruction, microcode: every signal")
+    parser.add_argument("--engine", type=Engine, choices=list(Engine), default=Engine.MICROCODE,
+                        help="microcode: signal-level model, instruction: whole instructions with the same tick count")
+    parser.add_argument("--data-memory", choices=list(memory_models), default="dict",
+                        help="dict: cell per dict entry, array: contiguous 64-bit cells")
+    parser.add_argument("--instruction-memory", choices=list(memory_models), default="dict",
+                        help="dict: cell per dict entry, array: contiguous 64-bit words")
+    parser.add_argument("--stream-output", action="store_true",
+                        help="don't keep a copy of the program output in memory for the final summary")
+    parser.add_argument("--data-stack-size", type=int, default=None,
+                        help="fixed data stack capacity, reports peak depth; growable when omitted")
+    parser.add_argument("--return-stack-size", type=int, default=None,
+                        help="fixed return stack capacity, reports peak depth; growable when omitted")
+    parser.add_argument("--data-cache", metavar="SPEC", default=None,
+                        help="data cache model, e.g. size=256,line=4,ways=2,replacement=lru|fifo|random,"
+                             "write=back|through,hit=1,miss=10; no cache when omitted")
+    parser.add_argument("--instruction-cache", metavar="SPEC", default=None,
+                        help="instruction cache model, same options as --data-cache plus prefetch=N next lines "
+                             "brought in on a miss; no cache when omitted")
+    parser.add_argument("--tos-register", action="store_true",
+                        help="keep the top of the data stack in a register, shortens ALU, read and dup microprograms")
+    parser.add_argument("--horizontal", action="store_true",
+                        help="horizontal microcode: independent signals of a microprogram fire in the same tick")
+    args = parser.parse_args()
+
+    level = logging.INFO if args.trace is TraceLevel.OFF else logging.DEBUG
+    logging.basicConfig(level=level, handlers=[logging.StreamHandler()], encoding="utf-8")
+    simulate(args.source, args.input, args.target, args.trace, args.engine, args.data_memory, args.instruction_memory,
+             not args.stream_output, args.data_stack_size, args.return_stack_size, args.data_cache,
+             args.instruction_cache, args.tos_register, args.horizontal)
     # simulate("dest.o", "input.txt", "result.txt")
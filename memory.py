@@ -1,3 +1,6 @@
+from array import array
+
+
 class Memory:
     def __init__(self):
         self._memory = {}
@@ -16,6 +19,14 @@ class Memory:
 
         return base_pointer
 
+    def load(self, values) -> int:
+        base_pointer = self.get_last_allocated()
+        self._memory.update(enumerate(values, base_pointer))
+
+        self._last_allocated += len(values)
+
+        return base_pointer
+
     def get_last_allocated(self):
         return self._last_allocated
 
@@ -44,3 +55,61 @@ class Memory:
 
     def __repr__(self):
         return str(self._memory)
+
+
+class ArrayMemory:
+    # Cells are machine words of the array typecode (64-bit signed by default): unlike Memory, a cell can't hold
+    # None or a value out of that range, such a store is an error naming the address and the value.
+    def __init__(self, typecode: str = "q"):
+        self._memory = array(typecode)
+
+        self.address_register = 0
+        self.data_register = 0
+
+    def allocate(self, size: int) -> int:
+        base_pointer = self.get_last_allocated()
+        self._memory.frombytes(bytes(size * self._memory.itemsize))
+
+        return base_pointer
+
+    def load(self, values) -> int:
+        base_pointer = self.get_last_allocated()
+        self._memory.extend(values)
+
+        return base_pointer
+
+    def get_last_allocated(self):
+        return len(self._memory)
+
+    def read(self):
+        key = self.address_register
+
+        assert 0 <= key < len(self._memory), f"Key {key} not found in memory"
+
+        self.data_register = self._memory[key]
+
+        return self.data_register
+
+    def write(self, value):
+        key = self.address_register
+
+        assert 0 <= key < len(self._memory), f"Key {key} not found in memory"
+
+        try:
+            self._memory[key] = value
+        except (OverflowError, TypeError):
+            assert False, f"value {value} at address {key} doesn't fit into a {self._memory.itemsize * 8}-bit cell"
+
+        self.data_register = value
+
+    def __str__(self):
+        return str(dict(enumerate(self._memory)))
+
+    def __repr__(self):
+        return str(self)
+
+
+memory_models: dict[str, type[Memory] | type[ArrayMemory]] = {
+    "dict": Memory,
+    "array": ArrayMemory,
+}
@@ -0,0 +1,78 @@
+import hashlib
+import os
+import shutil
+import tempfile
+from functools import cache
+
+# modules whose code decides what the translator writes, a change in any of them invalidates the cached objects
+TRANSLATOR_MODULES = ("translator.py", "optimizer.py", "isa.py")
+
+
+@cache
+def translator_version() -> str:
+    digest = hashlib.sha256()
+    for name in TRANSLATOR_MODULES:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), name), "rb") as file:
+            digest.update(file.read())
+    return digest.hexdigest()
+
+
+class ObjectCache:
+    # Translated programs (JSON or binary objects) in a directory, one file per key. The key is a hash of the
+    # source text, the translator options and the translator code. A hit refreshes the file time, and least recently
+    # used files are removed once the directory is larger than max_size bytes. Files are written to a temporary name
+    # and renamed, so processes sharing the directory never read a partial object.
+    def __init__(self, directory: str, max_size: int = 64 << 20):
+        assert max_size > 0, "object cache size must be positive"
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, source: bytes, *options: object) -> str:
+        digest = hashlib.sha256(translator_version().encode())
+        digest.update(repr(options).encode())
+        digest.update(source)
+        return digest.hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def get(self, key: str, dest_path: str) -> bool:
+        try:
+            shutil.copyfile(self.path(key), dest_path)
+            os.utime(self.path(key))
+        except FileNotFoundError:
+            # never stored or evicted by another process in the meantime
+            self.misses += 1
+            return False
+        self.hits += 1
+        return True
+
+    def put(self, key: str, object_path: str):
+        handle, temporary = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        os.close(handle)
+        shutil.copyfile(object_path, temporary)
+        os.replace(temporary, self.path(key))
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -0,0 +1,306 @@
+from collections import Counter
+from functools import cache
+from typing import Callable, Iterable, Iterator
+
+from isa import OPERAND_BITS, Instruction, Label, Line, OpCode, parse_line
+from machine import ControlUnit, DataPath
+
+# Forth words evaluated at compile time when their operands are literals, same results as the ALU
+folded_binary_terms: dict[str, Callable[[int, int], int]] = {
+    "+": lambda a, b: a + b,
+    "-": lambda a, b: a - b,
+    "*": lambda a, b: a * b,
+    "/": lambda a, b: a // b,
+    "mod": lambda a, b: a % b,
+    "=": lambda a, b: -1 if a == b else 0,
+    "<": lambda a, b: -1 if a < b else 0,
+    ">": lambda a, b: -1 if a > b else 0,
+}
+
+folded_unary_terms: dict[str, Callable[[int], int]] = {
+    "not": lambda a: int(not a),
+}
+
+# pattern: replacement, "{x}" matches any operand and must be the same everywhere in the pattern.
+# Labels never match, so no rewrite crosses a jump target.
+Rule = tuple[list[Instruction], list[Instruction]]
+
+
+def rule(pattern: str, replacement: str) -> Rule:
+    def instructions(text: str) -> list[Instruction]:
+        lines = [parse_line(line) for line in text.split(";") if line.strip()]
+        assert all(isinstance(line, Instruction) for line in lines), f"labels can't be used in rule {text}"
+        return [line for line in lines if isinstance(line, Instruction)]
+
+    return instructions(pattern), instructions(replacement)
+
+
+peephole_rules: list[Rule] = [
+    rule("push {x}; read", "read {x}"),
+    rule("push {x}; save", "save {x}"),
+    rule("push 0; eql; jmz {x}", "jnz {x}"),
+    rule("push 0; eql; jnz {x}", "jmz {x}"),
+    rule("not; jnz {x}", "jmz {x}"),
+    rule("not; jmz {x}", "jnz {x}"),
+    rule("push 1; add", "inc"),
+    rule("push 1; sub", "dec"),
+    rule("push {x}; pop", ""),
+    rule("dup; pop", ""),
+    rule("swap; swap", ""),
+]
+
+tail_call_rules: list[Rule] = [
+    rule("call {x}; ret", "jmp {x}"),
+]
+
+
+def is_literal(term: str) -> bool:
+    return term.isnumeric() or (term[0] == "-" and term[1:].isnumeric())
+
+
+def fits_operand(value: int) -> bool:
+    return -(1 << (OPERAND_BITS - 1)) <= value < (1 << (OPERAND_BITS - 1))
+
+
+def fold_constants(terms: Iterable[str], folded: Counter[str] | None = None) -> Iterator[str]:
+    # Literals stay on a compile-time stack until a word needs a value that is only known at run time.
+    # folded counts the words dropped from the program, every literal put back is subtracted under "0".
+    folded = Counter() if folded is None else folded
+    literals: list[int] = []
+    stream = iter(terms)
+
+    def flush() -> Iterator[str]:
+        folded["0"] -= len(literals)
+        yield from map(str, literals)
+        literals.clear()
+
+    term = next(stream, None)
+    while term is not None:
+        following = next(stream, None)
+
+        if term == ".\"":
+            yield from flush()
+            yield term
+            while following is not None:
+                yield following
+                closed = "\"" in following
+                following = next(stream, None)
+                if closed:
+                    break
+        elif term in ("variable", ":") or following == "cells":
+            yield from flush()
+            yield term
+            if following is not None:
+                yield following
+            following = next(stream, None)
+        elif is_literal(term):
+            literals.append(int(term))
+            folded["0"] += 1
+        elif term in folded_binary_terms and len(literals) >= 2 \
+                and not (term in ("/", "mod") and literals[-1] == 0) \
+                and fits_operand(folded_binary_terms[term](literals[-2], literals[-1])):
+            b = literals.pop()
+            a = literals.pop()
+            literals.append(folded_binary_terms[term](a, b))
+            folded[term] += 1
+        elif term in folded_unary_terms and literals:
+            literals.append(folded_unary_terms[term](literals.pop()))
+            folded[term] += 1
+        elif term == "dup" and literals:
+            literals.append(literals[-1])
+            folded[term] += 1
+        elif term == "drop" and literals:
+            literals.pop()
+            folded[term] += 1
+        elif term == "swap" and len(literals) >= 2:
+            literals[-1], literals[-2] = literals[-2], literals[-1]
+            folded[term] += 1
+        else:
+            yield from flush()
+            yield term
+
+        term = following
+
+    yield from flush()
+
+
+def is_placeholder(operand: int | str | None) -> bool:
+    return isinstance(operand, str) and operand.startswith("{")
+
+
+def match(pattern: list[Instruction], lines: list[Line]) -> dict[str, int | str] | None:
+    bindings: dict[str, int | str] = {}
+    for expected, line in zip(pattern, lines):
+        if not isinstance(line, Instruction) or expected.opcode is not line.opcode \
+                or (expected.operand is None) != (line.operand is None):
+            return None
+        if isinstance(expected.operand, str) and is_placeholder(expected.operand):
+            assert line.operand is not None
+            if bindings.setdefault(expected.operand, line.operand) != line.operand:
+                return None
+        elif expected.operand != line.operand:
+            return None
+    return bindings
+
+
+def substitute(replacement: list[Instruction], bindings: dict[str, int | str]) -> list[Line]:
+    return [Instruction(line.opcode, bindings[line.operand] if isinstance(line.operand, str) and is_placeholder(
+        line.operand) else line.operand) for line in replacement]
+
+
+def peephole(lines: list[Line], rules: list[Rule] = peephole_rules) -> list[Line]:
+    changed = True
+    while changed:
+        changed = False
+        result: list[Line] = []
+        i = 0
+        while i < len(lines):
+            for pattern, replacement in rules:
+                window = lines[i:i + len(pattern)]
+                bindings = match(pattern, window) if len(window) == len(pattern) else None
+                if bindings is not None:
+                    result.extend(substitute(replacement, bindings))
+                    i += len(pattern)
+                    changed = True
+                    break
+            else:
+                result.append(lines[i])
+                i += 1
+        lines = result
+    return lines
+
+
+def inline_procedures(instructions: list[Line], labels: dict[str, list[Line]],
+                      threshold: int) -> tuple[list[Line], dict[str, list[Line]]]:
+    # A body with labels of its own (loops, conditions) can only be moved to a single call site,
+    # the procedure itself is removed then. Bodies without labels are copied to every call site.
+    # Procedures are decided once, callees first, so a caller is measured with its callees already inlined.
+    ret = Instruction(OpCode.RET)
+    labels = dict(labels)
+    # references of every name, copies made by inlining included
+    sites = Counter(name for lines in (instructions, *labels.values()) for name in map(operand_of, lines)
+                    if name is not None)
+    # names used other than by a call (jumps) are never inlined
+    pinned = {operand_of(line) for lines in (instructions, *labels.values()) for line in lines
+              if operand_of(line) is not None and called(line) is None}
+    inlined: dict[str, list[Line]] = {}
+
+    def expand(lines: list[Line]) -> list[Line]:
+        expanded: list[Line] = []
+        for line in lines:
+            name = called(line)
+            # a body inlined earlier may call a procedure of the same cycle inlined later
+            expanded.extend(expand(inlined[name]) if name in inlined else [line])
+        return expanded
+
+    def decide(name: str):
+        block = labels[name] = expand(labels[name])
+        body = block[1:-1]
+        if block[-1] != ret or ret in body or sum(isinstance(line, Instruction) for line in body) > threshold:
+            return
+        if name in pinned or not sites[name] or any(operand_of(line) == name for line in body):
+            return
+        has_labels = any(isinstance(line, Label) for line in body)
+        if has_labels and sites[name] > 1:
+            return
+
+        # a moved body leaves its procedure, a copied one stays there until dead code elimination
+        copies = sites[name] - 1 if has_labels else sites[name]
+        for callee, count in Counter(map(operand_of, body)).items():
+            if callee is not None:
+                sites[callee] += copies * count
+        sites[name] = 0
+        inlined[name] = body
+        if has_labels:
+            del labels[name]
+
+    # iterative depth-first walk of the call graph, a procedure is decided once all its callees are
+    visited: set[str] = set()
+    for root in list(labels):
+        if root in visited:
+            continue
+        visited.add(root)
+        walk = [(root, map(operand_of, labels[root]))]
+        while walk:
+            name, callees = walk[-1]
+            callee = next((callee for callee in callees if callee in labels and callee not in visited), None)
+            if callee is None:
+                walk.pop()
+                decide(name)
+            else:
+                visited.add(callee)
+                walk.append((callee, map(operand_of, labels[callee])))
+
+    return expand(instructions), {name: expand(lines) for name, lines in labels.items()}
+
+
+def called(line: Line) -> str | None:
+    return line.operand if isinstance(line, Instruction) and line.opcode is OpCode.CALL \
+        and isinstance(line.operand, str) else None
+
+
+def operand_of(line: Line) -> str | None:
+    # symbolic operand: a label or a variable name
+    return line.operand if isinstance(line, Instruction) and isinstance(line.operand, str) else None
+
+
+def eliminate_dead_code(instructions: list[Line], labels: dict[str, list[Line]]) -> dict[str, list[Line]]:
+    # Blocks are kept only if they are reachable from the main code through jumps and calls, or by falling through
+    # from the previous block when it doesn't end with an unconditional transfer.
+    order = list(labels)
+    # the main code falls through into the first block
+    following_block: dict[str | None, str] = dict(zip([None, *order], order))
+    owners: dict[str, str | None] = {line.name: None for line in instructions if isinstance(line, Label)}
+    owners.update({line.name: name for name, lines in labels.items() for line in lines if isinstance(line, Label)})
+
+    reachable: set[str] = set()
+    pending: list[str | None] = [None]
+    while pending:
+        name = pending.pop()
+        lines = instructions if name is None else labels[name]
+
+        successors = [owners[target] for target in map(operand_of, lines) if target in owners]
+        code = [line for line in lines if isinstance(line, Instruction)]
+        if not code or code[-1].opcode not in (OpCode.JMP, OpCode.RET, OpCode.HLT):
+            if name in following_block:
+                successors.append(following_block[name])
+
+        for successor in successors:
+            if successor is not None and successor not in reachable:
+                reachable.add(successor)
+                pending.append(successor)
+
+    return {name: lines for name, lines in labels.items() if name in reachable}
+
+
+def referenced_names(instructions: list[Line], labels: dict[str, list[Line]]) -> set[str]:
+    return {operand for lines in (instructions, *labels.values()) for operand in map(operand_of, lines)
+            if operand is not None}
+
+
+def optimize(instructions: list[Line], labels: dict[str, list[Line]], rewrite: bool = True, inline_threshold: int = 0,
+             tail_calls: bool = False) -> tuple[list[Line], dict[str, list[Line]]]:
+    if inline_threshold:
+        instructions, labels = inline_procedures(instructions, labels, inline_threshold)
+    if rewrite:
+        instructions, labels = peephole(instructions), {name: peephole(lines) for name, lines in labels.items()}
+    if tail_calls:
+        instructions = peephole(instructions, tail_call_rules)
+        labels = {name: peephole(lines, tail_call_rules) for name, lines in labels.items()}
+    return instructions, labels
+
+
+@cache
+def cost_model() -> ControlUnit:
+    return ControlUnit(DataPath())
+
+
+def program_size(instructions: list[Line], labels: dict[str, list[Line]]) -> int:
+    return sum(isinstance(line, Instruction) for lines in (instructions, *labels.values()) for line in lines)
+
+
+def program_ticks(instructions: list[Line], labels: dict[str, list[Line]]) -> int:
+    # static estimate: every instruction of the program counted once, fetch included
+    control_unit = cost_model()
+    return sum(control_unit.instruction_ticks(line.opcode.value, line.operand is not None)
+               for lines in (instructions, *labels.values()) for line in lines if isinstance(line, Instruction))
@@ -4,7 +4,7 @@ class Stack:
         self.TOS = None
 
     def is_empty(self) -> bool:
-        return self.items == []
+        return not self.items
 
     def push(self, item):
         self.items.append(item)
@@ -32,3 +32,121 @@ class Stack:
 
     def __repr__(self):
         return str(self)
+
+
+class FixedStack(Stack):
+    def __init__(self, capacity: int):
+        super().__init__()
+        assert capacity > 0, "stack capacity must be positive"
+
+        self.items = [None] * capacity
+        self.capacity = capacity
+
+        self.sp = 0
+        self.peak = 0
+
+    def is_empty(self) -> bool:
+        return self.sp == 0
+
+    def push(self, item):
+        assert self.sp < self.capacity, f"stack overflow, capacity is {self.capacity}"
+
+        self.items[self.sp] = item
+        self.sp += 1
+
+        if self.sp > self.peak:
+            self.peak = self.sp
+
+    def pop(self):
+        assert self.sp > 0, "stack underflow"
+
+        self.sp -= 1
+        return self.items[self.sp]
+
+    def swap(self):
+        assert self.sp > 1, "stack underflow"
+
+        self.items[self.sp - 1], self.items[self.sp - 2] = self.items[self.sp - 2], self.items[self.sp - 1]
+
+    def peek(self):
+        assert self.sp > 0, "stack underflow"
+
+        return self.items[self.sp - 1]
+
+    def size(self) -> int:
+        return self.sp
+
+    def __str__(self):
+        return str(self.items[:self.sp])
+
+
+class TosStack(Stack):
+    # The top of the stack lives in the TOS register, the wrapped stack holds everything below it.
+    # A pop followed by a push can then be done as a single replace of the register.
+    def __init__(self, stack: Stack | None = None):
+        super().__init__()
+        self.stack: Stack = stack if stack is not None else Stack()
+        self.loaded = False
+
+    def is_empty(self) -> bool:
+        return not self.loaded
+
+    def push(self, item):
+        if self.loaded:
+            self.stack.push(self.TOS)
+        self.TOS = item
+        self.loaded = True
+
+    def pop(self):
+        if not self.loaded:
+            return self.stack.pop()
+
+        item = self.TOS
+        if self.stack.is_empty():
+            self.TOS = None
+            self.loaded = False
+        else:
+            self.TOS = self.stack.pop()
+        return item
+
+    def replace(self, item):
+        self.TOS = item
+        self.loaded = True
+
+    def spill(self):
+        # dup: the register keeps its value, a copy goes below it
+        assert self.loaded, "stack underflow"
+
+        self.stack.push(self.TOS)
+
+    def swap(self):
+        assert self.loaded and not self.stack.is_empty(), "stack underflow"
+
+        self.TOS, item = self.stack.pop(), self.TOS
+        self.stack.push(item)
+
+    def pop_two(self):
+        # save: the address in the register and the value under it are both used up
+        assert self.loaded and not self.stack.is_empty(), "stack underflow"
+
+        self.stack.pop()
+        self.loaded = False
+        self.TOS = None
+        if not self.stack.is_empty():
+            self.TOS = self.stack.pop()
+            self.loaded = True
+
+    def second(self):
+        assert self.loaded and not self.stack.is_empty(), "stack underflow"
+
+        return self.stack.peek()
+
+    def peek(self):
+        return self.TOS if self.loaded else self.stack.peek()
+
+    def size(self) -> int:
+        return self.stack.size() + self.loaded
+
+    def __str__(self):
+        items = self.stack.items[:self.stack.size()]
+        return str(items + [self.TOS] if self.loaded else items)
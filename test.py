@@ -1,11 +1,53 @@
+import io
+import json
 import os
 import tempfile
 import logging
+import time
+from collections import Counter
 
 import pytest
 
-from translator import translate
-from machine import simulate
+from translator import terms_to_assembly, tokenize, translate
+from machine import AluMuxSignalA, AluSignal, ControlUnit, DataPath, DataStackSignal, DsMuxSignal, Engine, \
+    check_microinstruction, pack_microcode, simulate, tos_tick_reduction
+from batch import run_batch, share, summary
+from cache import misses_by_label, parse_cache
+from device import InputDevice, OutputDevice
+from isa import Instruction, Label, Line, OpCode, parse_line
+from memory import ArrayMemory, Memory
+from object_cache import ObjectCache
+from optimizer import eliminate_dead_code, fold_constants, optimize, peephole, referenced_names
+from stack import FixedStack, TosStack
+from tick_table import README, tick_table
+from tracing import TraceLevel
+
+
+def translate_and_simulate(source: str, stdin: str = "", translate_options: dict | None = None,
+                           **simulate_options) -> tuple[str, ControlUnit]:
+    # translates the program in a temporary directory and runs it, returns the output and the control unit
+    simulate_options.setdefault("trace_level", TraceLevel.OFF)
+    with tempfile.TemporaryDirectory() as directory:
+        source_path, input_path, target, output_path = (
+            os.path.join(directory, name) for name in ("source.4th", "input.txt", "target.o", "output.txt"))
+        with open(source_path, "w", encoding="utf-8") as file:
+            file.write(source)
+        with open(input_path, "w", encoding="utf-8") as file:
+            file.write(stdin)
+
+        translate(source_path, target, **(translate_options or {}))
+        control_unit = simulate(target, input_path, output_path, **simulate_options)
+
+        with open(output_path, encoding="utf-8") as file:
+            return file.read(), control_unit
+
+
+def run_golden(golden, translate_options: dict | None = None, **simulate_options) -> tuple[str, ControlUnit]:
+    return translate_and_simulate(golden["in_source"], golden["in_stdin"], translate_options, **simulate_options)
+
+
+def golden_ticks(golden) -> int:
+    return int(golden["out_log"].splitlines()[-1].split("System time: ")[1].split(",")[0])
 
 
 @pytest.mark.golden_test("./golden/test/*.yml")
@@ -36,3 +78,453 @@ def test_translator_asm_and_machine(golden, caplog):
         assert code == golden["out_code"]
         assert out_text == golden["out_stdout"]
         assert caplog.text == golden["out_log"]
+
+
+@pytest.mark.golden_test("./golden/test/*.yml")
+@pytest.mark.parametrize("engine", [Engine.INSTRUCTION, Engine.JIT])
+def test_fast_engines(golden, caplog, engine):
+    caplog.set_level(logging.INFO)
+
+    out_text, _ = run_golden(golden, engine=engine)
+
+    assert out_text == golden["out_stdout"]
+    assert caplog.text.splitlines()[-1] == golden["out_log"].splitlines()[-1]
+
+
+@pytest.mark.golden_test("./golden/test/*.yml")
+@pytest.mark.parametrize("engine", list(Engine))
+def test_instruction_trace(golden, caplog, engine):
+    out_text, control_unit = run_golden(golden, engine=engine)
+
+    caplog.set_level(logging.DEBUG)
+    traced_text, traced = run_golden(golden, engine=engine, trace_level=TraceLevel.INSTRUCTION)
+    messages = [record.getMessage() for record in caplog.records]
+
+    # one decoded instruction per executed instruction and no microcode steps
+    assert [message.split(":")[0] for message in messages if message.startswith("Instruction n = ")] == \
+        [f"Instruction n = {n}" for n in range(traced.instruction_counter)]
+    assert not any(message.startswith("Processing mcode") for message in messages)
+    assert traced_text == out_text == golden["out_stdout"]
+    assert traced.ticks == control_unit.ticks
+    assert traced.instruction_counter == control_unit.instruction_counter
+
+
+@pytest.mark.golden_test("./golden/test/*.yml")
+@pytest.mark.parametrize("memory", ["dict", "array"])
+def test_binary_object(golden, caplog, memory):
+    caplog.set_level(logging.INFO)
+
+    out_text, _ = run_golden(golden, {"binary": True}, data_memory=memory, instruction_memory=memory)
+
+    assert out_text == golden["out_stdout"]
+    assert caplog.text.splitlines()[-1] == golden["out_log"].splitlines()[-1]
+
+
+@pytest.mark.golden_test("./golden/test/*.yml")
+def test_fixed_stacks(golden, caplog):
+    caplog.set_level(logging.INFO)
+
+    out_text, control_unit = run_golden(golden, engine=Engine.INSTRUCTION, data_stack_size=64, return_stack_size=8)
+
+    data_stack = control_unit.data_path.data_stack
+    return_stack = control_unit.data_path.return_stack
+
+    assert out_text == golden["out_stdout"]
+    assert caplog.text.splitlines()[-2] == golden["out_log"].splitlines()[-1]
+    assert caplog.text.splitlines()[-1].endswith(
+        f"Stack peak depth: data {data_stack.peak} of 64, return {return_stack.peak} of 8")
+
+
+def test_fixed_stack_bounds():
+    stack = FixedStack(2)
+
+    stack.push(1)
+    stack.push(2)
+    with pytest.raises(AssertionError, match="overflow"):
+        stack.push(3)
+
+    stack.swap()
+    assert stack.pop() == 1
+    assert stack.pop() == 2
+    assert stack.peak == 2
+    with pytest.raises(AssertionError, match="underflow"):
+        stack.pop()
+
+
+def test_array_memory_limits():
+    memory = ArrayMemory()
+    memory.allocate(2)
+    memory.address_register = 1
+    memory.write(-(1 << 63))
+    assert memory.read() == -(1 << 63)
+
+    for value in (1 << 63, None):
+        with pytest.raises(AssertionError, match=f"value {value} at address 1 doesn't fit into a 64-bit cell"):
+            memory.write(value)
+    assert memory.read() == -(1 << 63)
+
+    # the dict memory has no such limit
+    unbounded = Memory()
+    unbounded.allocate(1)
+    unbounded.write(1 << 63)
+    assert unbounded.read() == 1 << 63
+
+
+class RecordingStream(io.StringIO):
+    # remembers the size of every read and write the device makes
+    def __init__(self, text: str = ""):
+        super().__init__(text)
+        self.reads: list[int] = []
+        self.writes: list[int] = []
+
+    def read(self, size: int | None = -1) -> str:
+        chunk = super().read(size)
+        self.reads.append(len(chunk))
+        return chunk
+
+    def write(self, text: str) -> int:
+        self.writes.append(len(text))
+        return super().write(text)
+
+
+def test_input_device():
+    text = "".join(chr(ord("a") + i % 26) for i in range(4096 + 10))
+    stream = RecordingStream(text)
+    device = InputDevice(stream)
+
+    # characters 4095 and 4096 come from different chunks
+    assert "".join(chr(device.read()) for _ in text) == text
+    assert stream.reads == [4096, 10]
+
+    assert device.read() == 0
+    with pytest.raises(AssertionError, match="exhausted"):
+        device.read()
+
+
+def test_output_device():
+    stream = RecordingStream()
+    device = OutputDevice(stream, keep_copy=False)
+
+    text = "".join(chr(ord("a") + i % 26) for i in range(4096 + 5))
+    for char in text[:4096]:
+        device.write(ord(char))
+    # a full chunk goes to the stream without waiting for flush
+    assert stream.getvalue() == text[:4096]
+
+    for char in text[4096:]:
+        device.write(ord(char))
+    device.write(0)
+    assert stream.getvalue() == text[:4096]
+    device.flush()
+
+    # zero is not a character, it only gets into the copy
+    assert stream.getvalue() == text
+    assert stream.writes == [4096, 5]
+    assert device.buffer is None
+
+    copying = OutputDevice(None)
+    for value in (104, 0, 105):
+        copying.write(value)
+    copying.flush()
+    assert copying.buffer == [104, 0, 105]
+
+
+def test_tos_stack():
+    stack = TosStack(FixedStack(2))
+
+    stack.push(1)
+    stack.push(2)
+    stack.push(3)
+    assert (stack.TOS, stack.stack.size(), str(stack)) == (3, 2, "[1, 2, 3]")
+    with pytest.raises(AssertionError, match="overflow"):
+        stack.spill()
+
+    stack.swap()
+    stack.replace(stack.pop() + stack.pop())
+    assert str(stack) == "[5]"
+    assert stack.pop() == 5
+    assert stack.is_empty()
+
+    stack.push(7)
+    stack.push(8)
+    stack.push(9)
+    assert stack.second() == 8
+    stack.pop_two()
+    assert (stack.TOS, str(stack)) == (7, "[7]")
+    stack.push(6)
+    stack.pop_two()
+    assert stack.is_empty()
+
+
+@pytest.mark.golden_test("./golden/test/*.yml")
+@pytest.mark.parametrize("engine", list(Engine))
+def test_tos_register(golden, caplog, engine):
+    caplog.set_level(logging.INFO)
+
+    out_text, control_unit = run_golden(golden, engine=engine, tos_register=True)
+
+    assert out_text == golden["out_stdout"]
+    assert control_unit.ticks <= golden_ticks(golden)
+    assert caplog.text.splitlines()[-1].endswith("add 9 -> 8, sub 9 -> 8, mul 9 -> 8, div 9 -> 8, mod 9 -> 8, "
+                                                  "eql 9 -> 8, less 9 -> 8, lrg 9 -> 8, comp 9 -> 8, inc 8 -> 7, "
+                                                  "dec 8 -> 7, not 8 -> 7, read 6 -> 5, dup 2 -> 1, save 6 -> 5")
+    # horizontal microcode already does the pop and the push of a result in one tick
+    assert all(without == with_tos for without, with_tos in tos_tick_reduction(horizontal=True).values())
+
+
+@pytest.mark.golden_test("./golden/test/*.yml")
+@pytest.mark.parametrize("engine", list(Engine))
+def test_horizontal_microcode(golden, engine):
+    out_text, control_unit = run_golden(golden, engine=engine, horizontal=True)
+    _, traced = run_golden(golden, trace_level=TraceLevel.MICROCODE, horizontal=True)
+
+    assert out_text == golden["out_stdout"]
+    assert control_unit.ticks == traced.ticks < golden_ticks(golden)
+    assert control_unit.instruction_counter == traced.instruction_counter
+
+
+def test_microinstruction_conflicts():
+    with pytest.raises(AssertionError, match="latched in the same tick"):
+        check_microinstruction([AluMuxSignalA.ZERO, AluSignal.SET_A, AluSignal.ADD])
+    with pytest.raises(AssertionError, match="driven by another signal"):
+        check_microinstruction([DsMuxSignal.DS, DsMuxSignal.ALU])
+    with pytest.raises(AssertionError, match="before it is driven"):
+        check_microinstruction([DataStackSignal.PUSH, DsMuxSignal.ALU])
+
+    control_unit = ControlUnit(DataPath())
+    assert len(pack_microcode(control_unit.no_operand_mcode["fetch"])) == 3
+    assert [len(group) for group in pack_microcode(control_unit.no_operand_mcode["add"])] == [3, 3, 1, 2]
+
+
+@pytest.mark.golden_test("./golden/test/*.yml")
+@pytest.mark.parametrize("engine", list(Engine))
+def test_data_cache(golden, engine):
+    out_text, control_unit = run_golden(golden, engine=engine,
+                                        data_cache="size=8,line=2,ways=2,write=back,hit=1,miss=10")
+
+    cache = control_unit.data_path.data_cache
+
+    assert out_text == golden["out_stdout"]
+    assert control_unit.ticks == golden_ticks(golden) + cache.latency
+
+
+@pytest.mark.golden_test("./golden/test/*.yml")
+@pytest.mark.parametrize("engine", list(Engine))
+def test_instruction_cache(golden, engine):
+    out_text, control_unit = run_golden(golden, engine=engine,
+                                        instruction_cache="size=16,line=4,ways=2,miss=10,prefetch=1")
+
+    cache = control_unit.data_path.instruction_cache
+    labels = {label["name"]: label["idx"] for label in json.loads(golden["out_code"])["labels"]}
+
+    assert out_text == golden["out_stdout"]
+    assert control_unit.ticks == golden_ticks(golden) + cache.latency
+    assert cache.accesses == control_unit.instruction_counter
+    assert sum(misses_by_label(cache, labels).values()) == cache.misses
+
+
+def test_misses_by_label():
+    cache = parse_cache("size=4,line=1,ways=1,miss=10")
+    for address in (0, 3, 4, 5, 9):
+        cache.read(address)
+
+    # find_sum starts with a loop, both labels are at address 4
+    labels = {"find_sum": 4, "LOOP_LABEL_BEGIN_0": 4, "other": 9, "early": 3}
+    assert misses_by_label(cache, labels) == {"main": 1, "early": 1, "find_sum/LOOP_LABEL_BEGIN_0": 2, "other": 1}
+
+
+def test_cache_replacement():
+    lru = parse_cache("size=4,line=1,ways=2,replacement=lru,hit=1,miss=10")
+    fifo = parse_cache("size=4,line=1,ways=2,replacement=fifo,hit=1,miss=10")
+
+    for cache in (lru, fifo):
+        # addresses 0, 2, 4 share set 0
+        cache.read(0)
+        cache.read(2)
+        cache.read(0)
+        cache.read(4)
+
+    assert lru.read(0) == 1
+    assert fifo.read(0) == 10
+
+    write_back = parse_cache("size=2,line=1,ways=1,write=back,hit=1,miss=10")
+    assert write_back.write(0) == 10
+    assert write_back.write(0) == 1
+    assert write_back.read(2) == 20
+    assert write_back.writebacks == 1
+
+    write_through = parse_cache("size=2,line=1,ways=1,write=through,hit=1,miss=10")
+    assert write_through.write(0) == 10
+    assert write_through.read(2) == 10
+    assert write_through.writebacks == 0
+
+
+@pytest.mark.golden_test("./golden/test/*.yml")
+@pytest.mark.parametrize("options", [{}, {"inline_threshold": 32, "tail_calls": True}])
+def test_optimized_translation(golden, caplog, options):
+    caplog.set_level(logging.INFO)
+
+    out_text, control_unit = run_golden(golden, {"optimized": True, **options})
+
+    assert out_text == golden["out_stdout"]
+    assert control_unit.ticks <= golden_ticks(golden)
+    assert "Optimizer: " in caplog.text
+
+
+def asm(*lines: str) -> list[Line]:
+    return [parse_line(line) for line in lines]
+
+
+def test_instruction_ir():
+    assert parse_line("push -5") == Instruction(OpCode.PUSH, -5)
+    assert parse_line("read x") == Instruction(OpCode.READ, "x")
+    assert parse_line("loop:") == Label("loop")
+    assert list(map(str, asm("loop:", "jmz loop", "hlt"))) == ["loop:", "jmz loop", "hlt"]
+
+
+def test_peephole_rules():
+    assert peephole(asm("push x", "read", "push 1", "add", "push y", "save")) == asm("read x", "inc", "save y")
+    assert peephole(asm("read x", "push 0", "eql", "jmz L", "dup", "pop", "swap", "swap")) == asm("read x", "jnz L")
+    assert peephole(asm("push x", "L:", "read")) == asm("push x", "L:", "read")
+    assert peephole(asm("push 2", "add")) == asm("push 2", "add")
+
+
+def test_constant_folding():
+    assert list(fold_constants("-7 2 / 7 -2 mod 3 3 = not 4 dup * 1 2 swap - 9 drop".split())) == \
+        ["-4", "-1", "0", "16", "1"]
+    assert list(fold_constants("1 0 / x @ 2 + 3 x cells".split())) == \
+        ["1", "0", "/", "x", "@", "2", "+", "3", "x", "cells"]
+    assert list(fold_constants(['."', "1", '2"', "1", "2", "+"])) == ['."', "1", '2"', "3"]
+
+    # three pushes and two multiplications are replaced with a single push
+    folded: Counter[str] = Counter()
+    assert list(fold_constants(iter("60 60 * 24 * .".split()), folded)) == ["86400", "."]
+    assert folded == {"0": 2, "*": 2}
+
+
+def test_inlining_and_tail_calls():
+    labels = {"sq": asm("sq:", "dup", "mul", "ret"), "cube": asm("cube:", "dup", "call sq", "mul", "ret"),
+              "loop": asm("loop:", "jmp body", "loop_end:", "ret"), "body": asm("body:", "jnz body", "jmp loop_end")}
+    instructions, labels = optimize(asm("call cube", "call loop", "hlt"), labels, False, inline_threshold=8)
+
+    assert instructions == asm("dup", "dup", "mul", "mul", "jmp body", "loop_end:", "hlt")
+    assert "loop" not in labels
+    assert optimize(asm("call sq", "ret"), {}, False, tail_calls=True)[0] == asm("jmp sq")
+
+
+def test_inlining_scales():
+    # thousands of procedures called once each, the inliner has to stay close to linear in the program size
+    count = 3000
+    source = " ".join(f": p{n} {n} . ;" for n in range(count)) + " " + " ".join(f"p{n}" for n in range(count))
+
+    start = time.perf_counter()
+    out_text, control_unit = translate_and_simulate(source, translate_options={"inline_threshold": 8})
+
+    assert time.perf_counter() - start < 10
+    assert out_text == "".join(map(str, range(count)))
+    assert control_unit.instruction_counter == 2 * count + 1
+
+def test_dead_code_elimination():
+    labels = {"used": asm("used:", "jnz inner", "back:", "ret"), "inner": asm("inner:", "push x", "jmp back"),
+              "unused": asm("unused:", "push y", "call used"), "after_unused": asm("after_unused:", "ret"),
+              "falls": asm("falls:", "push 1"), "next": asm("next:", "ret")}
+    reachable = eliminate_dead_code(asm("call used", "call falls", "hlt"), labels)
+
+    assert list(reachable) == ["used", "inner", "falls", "next"]
+    assert referenced_names(asm("call used", "call falls", "hlt"), reachable) == {"used", "inner", "back", "x", "falls"}
+
+
+def test_print_numbers():
+    ticks = set()
+    for engine in Engine:
+        out_text, control_unit = translate_and_simulate("variable v 0 v ! v ? -45 . 1000 . 7 -3 - . cr", engine=engine)
+        assert out_text == "0-45100010\n"
+        ticks.add(control_unit.ticks)
+
+    assert len(ticks) == 1
+
+
+def test_nested_control_flow():
+    source = (": classify dup 0 = if drop 48 emit else 2 mod 0 = if 101 emit else 111 emit then then ; "
+              "2 0 do 4 0 do i cells classify loop 124 emit loop "
+              "1 if 3 begin dup . 1 - dup until drop then "
+              "5 0 do i cells 2 = if leave then i cells . loop")
+    for engine in Engine:
+        assert translate_and_simulate(source, engine=engine)[0] == "0oeo|0oeo|321015"
+
+    _, code, procedures = terms_to_assembly("1 if 2 0 do 3 0 do i cells . loop loop else 4 then".split())
+    assert not procedures and Instruction(OpCode.RET) not in code
+    assert Instruction(OpCode.READ, "i1") in code
+    with pytest.raises(AssertionError):
+        terms_to_assembly("1 if 2 0 do then loop".split())
+
+
+def test_object_cache():
+    with tempfile.TemporaryDirectory() as directory:
+        source = os.path.join(directory, "source.4th")
+        target = os.path.join(directory, "target.json")
+        with open(source, "w", encoding="utf-8") as file:
+            file.write(".\" Hello, World!\"")
+
+        object_cache = ObjectCache(os.path.join(directory, "cache"))
+        translate(source, target, object_cache=object_cache)
+        with open(target, encoding="utf-8") as file:
+            translated = file.read()
+        os.remove(target)
+
+        translate(source, target, object_cache=object_cache)
+        with open(target, encoding="utf-8") as file:
+            assert file.read() == translated
+        translate(source, target, binary=True, object_cache=object_cache)
+        assert (object_cache.hits, object_cache.misses) == (1, 2)
+
+        with open(source, "a", encoding="utf-8") as file:
+            file.write(" cr")
+        translate(source, target, object_cache=object_cache)
+        assert (object_cache.hits, object_cache.misses) == (1, 3)
+
+        # only the most recently used object fits
+        small = ObjectCache(object_cache.directory, os.path.getsize(target))
+        small.evict()
+        assert len(os.listdir(object_cache.directory)) == 1
+
+
+def test_batch():
+    with tempfile.TemporaryDirectory() as directory:
+        names = [os.path.join(directory, name) for name in ("alice.txt", "bob.txt", "out1.txt", "out2.txt")]
+        for name, text in zip(names, ("Alice\n", "Bob\n")):
+            with open(name, "w", encoding="utf-8") as file:
+                file.write(text)
+
+        entries = [("golden/src/hello_user.4th", names[0], names[2]), ("golden/src/hello_user.4th", names[1], names[3]),
+                   ("golden/src/hello_user.4th", os.path.join(directory, "missing.txt"), os.devnull)]
+        results = run_batch(entries, workers=2)
+
+        assert [result["status"] for result in results[:2]] == ["ok", "ok"]
+        assert results[2]["status"].startswith("FileNotFoundError")
+        with open(names[3], encoding="utf-8") as file:
+            assert file.read().endswith("Hello, Bob\n!")
+        assert results[0]["ticks"] > results[1]["ticks"]
+        assert summary(results, 1.0)["failed"] == 1
+
+    # workers keep the machine summary of every run out of the batch log
+    level = logging.getLogger().level
+    try:
+        share({})
+        assert not logging.getLogger().isEnabledFor(logging.INFO)
+    finally:
+        logging.getLogger().setLevel(level)
+
+
+def test_tick_table_is_up_to_date():
+    with open(README, encoding="utf-8") as file:
+        assert tick_table() in file.read(), "run python tick_table.py"
+
+
+def test_streaming_tokenizer():
+    lines = ["variable arr 3\n", "cells allot : show\n", "arr\n", "cells . ; show\n", '." hi there" cr\n']
+    streamed = terms_to_assembly(tokenize(iter(lines)))
+
+    assert streamed == terms_to_assembly("".join(lines).split())
+    assert streamed[0] == {"arr": 4}
+    assert streamed[2]["show"] == asm("show:", "read arr", "print", "ret")
@@ -0,0 +1,43 @@
+import re
+
+from isa import OpCode
+from machine import ControlUnit, DataPath
+from stack import TosStack
+
+README = "README.md"
+TABLE = re.compile(r"(<!-- tick table -->\n).*?(<!-- /tick table -->)", re.DOTALL)
+
+
+def tick_table() -> str:
+    # ticks of every microprogram in each control unit variant, taken from the microcode tables themselves
+    variants = [
+        ControlUnit(DataPath()),
+        ControlUnit(DataPath(), horizontal=True),
+        ControlUnit(DataPath(data_stack=TosStack())),
+        ControlUnit(DataPath(data_stack=TosStack()), horizontal=True),
+    ]
+
+    rows = [("выборка", [len(unit.microinstructions(unit.no_operand_mcode["fetch"])) for unit in variants])]
+    for opcode in OpCode:
+        for mcode, name in (("no_operand_mcode", f"`{opcode.value}`"), ("one_operand_mcode", f"`{opcode.value} n`")):
+            if opcode.value in getattr(variants[0], mcode):
+                rows.append((name, [len(unit.microinstructions(getattr(unit, mcode)[opcode.value])) for unit in variants]))
+
+    lines = [
+        "| Микропрограмма | Такты | `--horizontal` | `--tos-register` | `--tos-register --horizontal` |",
+        "|:--------------:|:-----:|:--------------:|:----------------:|:-----------------------------:|",
+    ]
+    lines += [f"| {name} | {' | '.join(map(str, ticks))} |" for name, ticks in rows]
+    return "\n".join(lines) + "\n"
+
+
+def update_readme(path: str = README):
+    with open(path, encoding="utf-8") as file:
+        text = file.read()
+    assert TABLE.search(text), f"no tick table markers in {path}"
+    with open(path, "w", encoding="utf-8") as file:
+        file.write(TABLE.sub(lambda match: match.group(1) + tick_table() + match.group(2), text))
+
+
+if __name__ == "__main__":
+    update_readme()
@@ -0,0 +1,74 @@
+import logging
+from collections import Counter
+from enum import Enum
+
+from cache import Cache
+from stack import FixedStack, Stack, TosStack
+
+
+class TraceLevel(Enum):
+    OFF = "off"
+    INSTRUCTION = "instruction"
+    MICROCODE = "microcode"
+
+    def __str__(self):
+        return self.value
+
+
+class Tracer:
+    def __init__(self, level: TraceLevel = TraceLevel.OFF):
+        self.level = level
+
+    @staticmethod
+    def from_logging() -> "Tracer":
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            return Tracer(TraceLevel.MICROCODE)
+        return Tracer(TraceLevel.OFF)
+
+    def fetch(self, instruction_pointer: int):
+        logging.debug(f"Fetching instruction id = {instruction_pointer}")
+
+    def decoded(self, instruction_counter: int, instruction_register):
+        logging.debug(f"Instruction n = {instruction_counter}: {instruction_register}")
+
+    def operand(self, operand_flag: int, operand):
+        if operand_flag:
+            logging.debug(f"Has operand {operand}")
+        else:
+            logging.debug("Has no operand")
+
+    def signal(self, mc):
+        logging.debug(f"Processing mcode instruction {mc}")
+
+    def state(self, data_stack, return_stack, output_buffer, alu):
+        logging.debug(f"DS: {data_stack} RS: {return_stack} OutBuffer: {output_buffer} ALU: res = {alu.result}, a = {alu.a}, b = {alu.b}")
+
+    def summary(self, ticks: int, instruction_counter: int, output_buffer):
+        if output_buffer is None:
+            logging.info(f"System time: {ticks}, instructions: {instruction_counter}")
+        else:
+            logging.info(f"System time: {ticks}, instructions: {instruction_counter}, output buffer: {output_buffer}")
+
+    def stack_usage(self, data_stack: Stack, return_stack: Stack):
+        if isinstance(data_stack, TosStack):
+            # the register is not counted, the capacity is that of the stack memory below it
+            data_stack = data_stack.stack
+        usage = [f"{name} {stack.peak} of {stack.capacity}"
+                 for name, stack in (("data", data_stack), ("return", return_stack)) if isinstance(stack, FixedStack)]
+        if usage:
+            logging.info(f"Stack peak depth: {', '.join(usage)}")
+
+    def tos_usage(self, reduction: dict[str, tuple[int, int]]):
+        per_opcode = ", ".join(f"{name} {before} -> {after}" for name, (before, after) in reduction.items())
+        logging.info(f"TOS register ticks per instruction: {per_opcode}")
+
+    def cache_usage(self, name: str, cache: Cache):
+        hit_rate = cache.hits / cache.accesses if cache.accesses else 0
+        logging.info(f"{name}: accesses: {cache.accesses}, hits: {cache.hits}, misses: {cache.misses} "
+                     f"(read {cache.read_misses}, write {cache.write_misses}), hit rate: {hit_rate:.2%}, "
+                     f"writebacks: {cache.writebacks}, prefetches: {cache.prefetches}, stall ticks: {cache.latency}")
+
+    def label_misses(self, name: str, misses: Counter[str]):
+        if misses:
+            by_label = ", ".join(f"{label}: {count}" for label, count in misses.most_common())
+            logging.info(f"{name} misses by label: {by_label}")
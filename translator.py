@@ -1,402 +1,336 @@
-import sys
+import argparse
 import json
-
-terms_to_instructions: dict[str, list[str]] = {
-    "=": ["eql"],
-    "<": ["less"],
-    ">": ["lrg"],
-    "dup": ["dup"],
-    "drop": ["pop"],
-    "swap": ["swap"],
-    "+": ["add"],
-    "-": ["sub"],
-    "*": ["mul"],
-    "/": ["div"],
-    "mod": ["mod"],
-    "not": ["not"],
-    "key": ["read INPUT"],
-    "!": ["save"],
-    "@": ["read"],
-    "?": ["read", "save out_temp", "push 0", "jmp system_number_prepare", "jmp system_number_print"],
-    ".": ["save out_temp", "jmp system_number_prepare", "jmp system_number_print"],
-    "emit": ["save OUTPUT"],
-    "cr": ["push 13", "save OUTPUT"],
+import logging
+import re
+from collections import Counter, deque
+from itertools import chain
+from typing import Callable, Iterable, Iterator
+
+from isa import Instruction, Label, Line, OpCode, encode, write_object
+from object_cache import ObjectCache
+from optimizer import eliminate_dead_code, fold_constants, is_literal, optimize, program_size, program_ticks, \
+    referenced_names
+
+# data memory cells used by the generated code, placed right after the INPUT and OUTPUT ports
+SYSTEM_VARIABLES = ("i", "end")
+
+terms_to_instructions: dict[str, list[Line]] = {
+    "=": [Instruction(OpCode.EQL)],
+    "<": [Instruction(OpCode.LESS)],
+    ">": [Instruction(OpCode.LRG)],
+    "dup": [Instruction(OpCode.DUP)],
+    "drop": [Instruction(OpCode.POP)],
+    "swap": [Instruction(OpCode.SWAP)],
+    "+": [Instruction(OpCode.ADD)],
+    "-": [Instruction(OpCode.SUB)],
+    "*": [Instruction(OpCode.MUL)],
+    "/": [Instruction(OpCode.DIV)],
+    "mod": [Instruction(OpCode.MOD)],
+    "not": [Instruction(OpCode.NOT)],
+    "key": [Instruction(OpCode.READ, "INPUT")],
+    "!": [Instruction(OpCode.SAVE)],
+    "@": [Instruction(OpCode.READ)],
+    "?": [Instruction(OpCode.READ), Instruction(OpCode.PRINT)],
+    ".": [Instruction(OpCode.PRINT)],
+    "emit": [Instruction(OpCode.SAVE, "OUTPUT")],
+    "cr": [Instruction(OpCode.PUSH, 13), Instruction(OpCode.SAVE, "OUTPUT")],
 }
 
 
-def terms_to_assembly(terms: list[str]) -> tuple[dict[str, int], list[str], dict[str, list[str]]]:
-    variables: dict[str, int] = {}  # name: size
-    procedures: list[str] = []  # list of names
-    conditions: list[str] = []  # list of names
-    loops: list[str] = []  # list of names
-    code: list[str] = []  # list of instructions
-    labels_code: dict[str, list[str]] = {
-        "system_number_prepare": ["system_number_prepare:", "read out_temp", "dup", "push 10", "read out_temp",
-                                  "push 10", "div", "mul", "sub",
-                                  "push 48", "add", "swap", "push 10", "div", "dup", "save out_temp",
-                                  "push 0", "eql", "jmz system_number_prepare", "ret"],
-        "system_number_print": ["system_number_print:", "dup", "save OUTPUT", "jnz system_number_print", "ret"],
-    }  # name: list of instructions
-
-    i: int = 0
-    in_condition: bool = False
-    in_function: bool = False
-    in_loop: bool = False
-    in_print: bool = False
-
-    while i < len(terms):
-        if in_print:
-            for char in terms[i]:
-                if char == "\"":
-                    in_print = False
-                    break
-
-                if in_condition:
-                    labels_code[conditions[-1]].extend([f"push {ord(char)}", "save OUTPUT"])
-                elif in_loop:
-                    labels_code[loops[-1]].extend([f"push {ord(char)}", "save OUTPUT"])
-                elif in_function:
-                    labels_code[procedures[-1]].extend([f"push {ord(char)}", "save OUTPUT"])
-                else:
-                    code.extend([f"push {ord(char)}", "save OUTPUT"])
-
-            else:
-                if in_condition:
-                    labels_code[conditions[-1]].extend(["push 32", "save OUTPUT"])
-                elif in_loop:
-                    labels_code[loops[-1]].extend(["push 32", "save OUTPUT"])
-                elif in_function:
-                    labels_code[procedures[-1]].extend(["push 32", "save OUTPUT"])
-                else:
-                    code.extend(["push 32", "save OUTPUT"])
-
-            i += 1
-
-        elif (terms[i] == "variable") and (i + 4 < len(terms)) and (" ".join(terms[i + 3:i + 5]) == "cells allot"):
-            assert not any([in_condition, in_function, in_loop]), f"variable definition is not allowed in word {i}"
-            assert terms[i + 1] != "i", "name 'i' can't be redefined as it used by the system"
-            assert terms[i + 1] != "end", "name 'end' can't be redefined as it used by the system"
-            assert terms[i + 1] != "out_temp", "name 'out_temp' can't be redefined as it used by the system"
-            assert terms[i + 1] != "system_number_print", \
-                "name 'system_number_print' can't be redefined as it used by the system"
-
-            variables[terms[i + 1]] = 1 + int(terms[i + 2])
-
-            i += 5
-
-        elif terms[i] == "variable":
-            assert not any([in_condition, in_function, in_loop]), f"variable definition is not allowed in word {i}"
-            assert terms[i + 1] != "i", "name 'i' can't be redefined as it used by the system"
-            assert terms[i + 1] != "end", "name 'end' can't be redefined as it used by the system"
-            assert terms[i + 1] != "out_temp", "name 'out_temp' can't be redefined as it used by the system"
-            assert terms[i + 1] != "system_number_print", \
-                "name 'system_number_print' can't be redefined as it used by the system"
-
-            variables[terms[i + 1]] = 1
-
-            i += 2
-
-        elif terms[i] == ":":
-            assert not in_function, "nested functions are not allowed in that implementation"
-            assert not any([in_condition, in_loop]), f"function definition is not allowed in word {i}"
-            assert terms[i + 1] != "system_number_print", \
-                "name 'system_number_print' can't be redefined as it used by the system"
-
-            in_function = True
-
-            procedures.append(terms[i + 1])
-            labels_code[terms[i + 1]] = [f"{terms[i + 1]}:"]
-
-            i += 2
-
-        elif terms[i] == ";":
-            assert in_function, f"unexpected function ending was found in word {i}"
-
-            in_function = False
-
-            labels_code[procedures[-1]].append(f"ret")
-
-            i += 1
-
-        elif terms[i] == "if":
-            assert not in_condition, "nested conditions are not allowed in that implementation"
-
-            in_condition = True
-
-            label_name = f"CONDITION_LABEL_IF_{hex(len(conditions))[2:]}"
-            conditions.append(label_name)
-
-            labels_code[label_name] = [f"{label_name}:"]
-
-            if in_loop:
-                labels_code[loops[-1]].append(f"jnz {label_name}")
-            elif in_function:
-                labels_code[procedures[-1]].append(f"jnz {label_name}")
-            else:
-                code.append(f"jnz {label_name}")
-
-            i += 1
-
-        elif terms[i] == "else":
-            assert in_condition, f"unexpected else statement ending was found in word {i}"
-
-            label_name = f"CONDITION_LABEL_ELSE_{conditions[-1][-1]}"
-            conditions.append(label_name)
-
-            labels_code[conditions[-2]].append("ret")
-
-            labels_code[label_name] = [f"{label_name}:"]
-
-            if in_loop:
-                labels_code[loops[-1]].append(f"jmp {label_name}")
-            elif in_function:
-                labels_code[procedures[-1]].append(f"jmp {label_name}")
-            else:
-                code.append(f"jmp {label_name}")
-
-            i += 1
-
-        elif terms[i] == "then":
-            assert in_condition, f"unexpected condition ending was found in word {i}"
-
-            in_condition = False
-
-            labels_code[conditions[-1]].append("ret")
-
-            i += 1
-
-        elif terms[i] == "begin":
-            assert not in_loop, "nested loops are not allowed in that implementation"
-            assert not in_condition, "loops inside a conditions are not allowed in that implementation"
-
-            in_loop = True
-
-            label_name = f"LOOP_LABEL_BEGIN_{len(loops)}"
-            loops.append(label_name)
-
-            labels_code[label_name] = [f"{label_name}:"]
-
-            if in_function:
-                labels_code[procedures[-1]].append(f"jmp {label_name}")
-            else:
-                code.append(f"jmp {label_name}")
-
-            i += 1
-
-        elif terms[i] == "until":
-            assert in_loop, f"unexpected loop ending was found in word {i}"
-
-            in_loop = False
-
-            labels_code[loops[-1]].extend([f"jnz {loops[-1]}", "ret"])
-
-            i += 1
-
-        elif terms[i] == "do":
-            assert not in_loop, "nested loops are not allowed in that implementation"
-            assert not in_condition, "loops inside a conditions are not allowed in that implementation"
-
-            in_loop = True
-
-            label_name = f"LOOP_LABEL_DO_{len(loops)}"
-            loops.append(label_name)
-
-            labels_code[label_name] = [f"{label_name}:"]
-
-            if in_function:
-                labels_code[procedures[-1]].extend(["save i", "save end", f"jmp {label_name}"])
-            else:
-                code.extend(["save i", "save end", f"jmp {label_name}"])
-
-            i += 1
-
-        elif terms[i] == "loop":
-            assert in_loop, f"unexpected loop ending was found in word {i}"
-
-            in_loop = False
-
-            labels_code[loops[-1]].extend(["push i", "read", "inc", "dup", "save i",
-                                           "push end", "read", "less", f"jnz {loops[-1]}", "ret"])
-
-            i += 1
-
-        elif terms[i] == "leave":
-            assert in_loop, f"unexpected leaving from loop was found in word {i}"
-
-            if in_condition:
-                labels_code[conditions[-1]].extend(["push end", "read", "push i", "save"])
+def term_instructions(term: str) -> list[Line]:
+    # code of a word that is compiled the same everywhere: an instruction word or a literal
+    return terms_to_instructions[term] if term in terms_to_instructions else [Instruction(OpCode.PUSH, int(term))]
+
+
+def tokenize(lines: Iterable[str]) -> Iterator[str]:
+    for line in lines:
+        yield from line.split()
+
+
+class Terms:
+    # Word stream with the few words of lookahead the language needs ("variable name n cells allot", "name cells")
+    def __init__(self, terms: Iterable[str]):
+        self.terms = iter(terms)
+        self.ahead: deque[str] = deque()
+        self.index = -1  # number of the last word taken, for error messages
+
+    def peek(self, offset: int = 0) -> str | None:
+        while len(self.ahead) <= offset:
+            term = next(self.terms, None)
+            if term is None:
+                return None
+            self.ahead.append(term)
+        return self.ahead[offset]
+
+    def take(self) -> str | None:
+        term = self.peek()
+        if term is not None:
+            self.ahead.popleft()
+            self.index += 1
+        return term
+
+    def skip(self, count: int):
+        for _ in range(count):
+            self.take()
+
+
+def loop_counters(depth: int) -> tuple[str, str]:
+    # index and limit cells of a do loop nested at that depth, the outermost loop uses the system variables
+    return ("i", "end") if depth == 0 else (f"i{depth}", f"end{depth}")
+
+
+class Compiler:
+    def __init__(self):
+        self.variables: dict[str, int] = {}  # name: size
+        self.procedures: set[str] = set()
+        self.conditions: int = 0  # number of conditions so far, used in their labels
+        self.loops: int = 0  # number of loops so far, used in their labels
+        self.code: list[Line] = []
+        self.labels_code: dict[str, list[Line]] = {}  # name: list of instructions
+
+        # Open control structures, innermost last: the word that opened it and its number. Their branches are
+        # emitted inline, forward ones to labels placed when the structure is closed.
+        self.control: list[tuple[str, int]] = []
+
+        # block the next instructions go to: the main code or the procedure being defined
+        self.target: list[Line] = self.code
+
+        self.handlers: dict[str, Callable[[Terms], None]] = {
+            "variable": self.variable,
+            ":": self.begin_procedure,
+            ";": self.end_procedure,
+            "if": self.begin_if,
+            "else": self.begin_else,
+            "then": self.end_if,
+            "begin": self.begin_until,
+            "until": self.end_until,
+            "do": self.begin_do,
+            "loop": self.end_do,
+            "leave": self.leave,
+            ".\"": self.print_string,
+        }
+
+    def compile(self, terms: Terms):
+        while (term := terms.take()) is not None:
+            handler = self.handlers.get(term)
+            if handler is not None:
+                handler(terms)
+            elif term in terms_to_instructions:
+                self.target.extend(terms_to_instructions[term])
+            elif term in self.procedures:
+                self.target.append(Instruction(OpCode.CALL, term))
+            elif terms.peek() == "cells":
+                terms.take()
+                self.target.append(Instruction(OpCode.READ, self.loop_index() if term == "i" else term))
+            elif term in self.variables:
+                self.target.append(Instruction(OpCode.PUSH, term))
+            elif is_literal(term):
+                self.target.append(Instruction(OpCode.PUSH, int(term)))
             else:
-                labels_code[loops[-1]].extend(["push end", "read", "push i", "save"])
+                assert False, f"term {term} is undefined, you can't use it"
 
-            i += 1
+        assert not self.control, f"{self.control[-1][0]} is never closed"
+        assert self.target is self.code, "function definition is never closed"
+        self.code.append(Instruction(OpCode.HLT))
 
-        elif terms[i] == ".\"":
-            assert not in_loop, "nested loops are not allowed in that implementation"
-            assert not in_condition, "loops inside a conditions are not allowed in that implementation"
+    def open(self, word: str, number: int):
+        self.control.append((word, number))
 
-            in_print = True
+    def close(self, terms: Terms, word: str, *openers: str) -> tuple[str, int]:
+        assert self.control and self.control[-1][0] in openers, f"unexpected {word} was found in word {terms.index}"
+        return self.control.pop()
 
-            i += 1
+    def do_depth(self) -> int:
+        return sum(word == "do" for word, _ in self.control)
 
-        elif terms[i] in terms_to_instructions.keys():
-            if in_condition:
-                labels_code[conditions[-1]].extend(terms_to_instructions[terms[i]])
-            elif in_loop:
-                labels_code[loops[-1]].extend(terms_to_instructions[terms[i]])
-            elif in_function:
-                labels_code[procedures[-1]].extend(terms_to_instructions[terms[i]])
-            else:
-                code.extend(terms_to_instructions[terms[i]])
+    def loop_index(self) -> str:
+        # "i" is the index of the innermost do loop
+        return loop_counters(max(self.do_depth() - 1, 0))[0]
 
-            i += 1
+    def variable(self, terms: Terms):
+        assert self.target is self.code and not self.control, \
+            f"variable definition is not allowed in word {terms.index}"
+        name = terms.take()
+        assert name is not None, "variable name is missing"
+        assert not re.fullmatch(r"(i|end)\d*", name), f"name '{name}' can't be redefined as it used by the system"
 
-        elif terms[i] in procedures:
-            if in_condition:
-                labels_code[conditions[-1]].append(f"jmp {terms[i]}")
-            elif in_loop:
-                labels_code[loops[-1]].append(f"jmp {terms[i]}")
-            elif in_function:
-                labels_code[procedures[-1]].append(f"jmp {terms[i]}")
-            else:
-                code.append(f"jmp {terms[i]}")
+        if terms.peek(1) == "cells" and terms.peek(2) == "allot":
+            self.variables[name] = 1 + int(terms.ahead[0])
+            terms.skip(3)
+        else:
+            self.variables[name] = 1
+
+    def begin_procedure(self, terms: Terms):
+        assert self.target is self.code, "nested functions are not allowed in that implementation"
+        assert not self.control, f"function definition is not allowed in word {terms.index}"
+        name = terms.take()
+        assert name is not None, "function name is missing"
+
+        self.procedures.add(name)
+        self.labels_code[name] = [Label(name)]
+        self.target = self.labels_code[name]
+
+    def end_procedure(self, terms: Terms):
+        assert self.target is not self.code, f"unexpected function ending was found in word {terms.index}"
+        assert not self.control, f"{self.control[-1][0]} is not closed in word {terms.index}"
+
+        self.target.append(Instruction(OpCode.RET))
+        self.target = self.code
+
+    def begin_if(self, _terms: Terms):
+        # a false flag jumps over the true branch, to the else branch or past the condition
+        self.target.append(Instruction(OpCode.JMZ, f"CONDITION_LABEL_ELSE_{self.conditions}"))
+        self.open("if", self.conditions)
+        self.conditions += 1
+
+    def begin_else(self, terms: Terms):
+        _, number = self.close(terms, "else", "if")
+        self.target.extend([Instruction(OpCode.JMP, f"CONDITION_LABEL_THEN_{number}"),
+                            Label(f"CONDITION_LABEL_ELSE_{number}")])
+        self.open("else", number)
+
+    def end_if(self, terms: Terms):
+        word, number = self.close(terms, "then", "if", "else")
+        self.target.append(Label(f"CONDITION_LABEL_{'ELSE' if word == 'if' else 'THEN'}_{number}"))
+
+    def begin_until(self, _terms: Terms):
+        self.target.append(Label(f"LOOP_LABEL_BEGIN_{self.loops}"))
+        self.open("begin", self.loops)
+        self.loops += 1
+
+    def end_until(self, terms: Terms):
+        # the loop repeats while the flag is not zero
+        _, number = self.close(terms, "until", "begin")
+        self.target.append(Instruction(OpCode.JNZ, f"LOOP_LABEL_BEGIN_{number}"))
+
+    def begin_do(self, _terms: Terms):
+        index, limit = loop_counters(self.do_depth())
+        for name in (index, limit):
+            if name not in SYSTEM_VARIABLES:
+                self.variables.setdefault(name, 1)
+
+        self.target.extend([Instruction(OpCode.SAVE, index), Instruction(OpCode.SAVE, limit),
+                            Label(f"LOOP_LABEL_DO_{self.loops}")])
+        self.open("do", self.loops)
+        self.loops += 1
+
+    def end_do(self, terms: Terms):
+        _, number = self.close(terms, "loop", "do")
+        index, limit = loop_counters(self.do_depth())
+        self.target.extend([Instruction(OpCode.PUSH, index), Instruction(OpCode.READ), Instruction(OpCode.INC),
+                            Instruction(OpCode.DUP), Instruction(OpCode.SAVE, index), Instruction(OpCode.PUSH, limit),
+                            Instruction(OpCode.READ), Instruction(OpCode.LESS),
+                            Instruction(OpCode.JNZ, f"LOOP_LABEL_DO_{number}")])
+
+    def leave(self, terms: Terms):
+        # the innermost do loop ends after the current iteration
+        assert self.do_depth(), f"unexpected leaving from loop was found in word {terms.index}"
+        index, limit = loop_counters(self.do_depth() - 1)
+        self.target.extend([Instruction(OpCode.PUSH, limit), Instruction(OpCode.READ), Instruction(OpCode.PUSH, index),
+                            Instruction(OpCode.SAVE)])
+
+    def print_string(self, terms: Terms):
+        # every word up to the closing quote is printed followed by a space, the rest of that word is dropped
+        while (term := terms.take()) is not None:
+            for char in term:
+                if char == "\"":
+                    return
+                self.target.extend([Instruction(OpCode.PUSH, ord(char)), Instruction(OpCode.SAVE, "OUTPUT")])
+            self.target.extend([Instruction(OpCode.PUSH, 32), Instruction(OpCode.SAVE, "OUTPUT")])
 
-            i += 1
 
-        elif i + 1 < len(terms) and terms[i + 1] == "cells":
-            if in_condition:
-                labels_code[conditions[-1]].append(f"read {terms[i]}")
-            elif in_loop:
-                labels_code[loops[-1]].append(f"read {terms[i]}")
-            elif in_function:
-                labels_code[procedures[-1]].append(f"read {terms[i]}")
-            else:
-                code.append(f"read {terms[i]}")
+def terms_to_assembly(terms: Iterable[str]) -> tuple[dict[str, int], list[Line], dict[str, list[Line]]]:
+    compiler = Compiler()
+    compiler.compile(Terms(terms))
+    return compiler.variables, compiler.code, compiler.labels_code
 
-            i += 2
 
-        elif terms[i] in variables or terms[i].isnumeric() or (terms[i][0] == "-" and terms[i][1:].isnumeric()):
-            if in_condition:
-                labels_code[conditions[-1]].append(f"push {terms[i]}")
-            elif in_loop:
-                labels_code[loops[-1]].append(f"push {terms[i]}")
-            elif in_function:
-                labels_code[procedures[-1]].append(f"push {terms[i]}")
-            else:
-                code.append(f"push {terms[i]}")
+def link(variables: dict[str, int], instructions: list[Line], labels: dict[str, list[Line]],
+         system_variables: tuple[str, ...] = SYSTEM_VARIABLES) -> tuple[list[tuple[int, int]], list[Instruction],
+                                                                        dict[str, int]]:
+    # Lays out data memory and the code (main code first, then the blocks in order) and replaces symbolic operands
+    # with addresses: a label if there is one with that name, a variable otherwise.
+    variables_to_idx: dict[str, int] = {"INPUT": 0, "OUTPUT": 1}
+    memory: list[tuple[int, int]] = [(0, 1), (1, 1)]
 
-            i += 1
+    cell = 2
+    for name, size in [*((name, 1) for name in system_variables), *variables.items()]:
+        variables_to_idx[name] = cell
+        memory.append((cell, size))
+        cell += size
 
+    labels_to_idx: dict[str, int] = {}
+    program: list[Instruction] = []
+    for line in chain(instructions, *labels.values()):
+        if isinstance(line, Label):
+            labels_to_idx[line.name] = len(program)
         else:
-            assert False, f"term {terms[i]} is undefined, you can't use it"
+            program.append(line)
 
-    code.append("hlt")
-    return variables, code, labels_code
+    def address(operand: int | str | None) -> int | str | None:
+        if not isinstance(operand, str):
+            return operand
+        assert operand in labels_to_idx or operand in variables_to_idx, f"name {operand} is undefined"
+        return labels_to_idx.get(operand, variables_to_idx.get(operand))
 
+    return memory, [Instruction(line.opcode, address(line.operand)) for line in program], labels_to_idx
 
-def asm_to_machine(variables: dict[str, int],
-                   instructions: list[str],
-                   labels: dict[str, list[str]]) -> dict[str, list[dict[str | int, str | int]]]:
-    variables_to_idx: dict[str, int] = {"INPUT": 0, "OUTPUT": 1, "out_temp": 2, "i": 3, "end": 4}
-    processed_variables: list[dict[str | int, str | int]] = [
-        {"idx": 0, "size": 1}, {"idx": 1, "size": 1},
-        {"idx": 2, "size": 1}, {"idx": 3, "size": 1}, {"idx": 4, "size": 1}
-    ]
 
-    cell = 5
-    for name, size in variables.items():
-        variables_to_idx[name] = cell
-        processed_variables.append({
-            "idx": cell,
-            "size": size,
-        })
-        cell += size
-
-    idx = len(instructions)
-    labels_to_idx: dict[str, int] = {}
-    processed_code: list[dict[str | int, str | int]] = []
-    processed_labels: list[dict[str | int, str | int]] = []
-
-    for name, lines in labels.items():
-        labels_to_idx[name] = idx
-        idx += len(lines) - 1
-
-    idx = 0
-
-    for instruction in instructions:
-        parts = instruction.split()
-        if len(parts) == 2:
-            if parts[1] in labels_to_idx.keys():
-                processed_code.append({
-                    "idx": idx,
-                    "opcode": parts[0],
-                    "operand": labels_to_idx[parts[1]]
-                })
-            elif parts[1] in variables_to_idx.keys():
-                processed_code.append({
-                    "idx": idx,
-                    "opcode": parts[0],
-                    "operand": variables_to_idx[parts[1]]
-                })
-            else:
-                processed_code.append({
-                    "idx": idx,
-                    "opcode": parts[0],
-                    "operand": int(parts[1])
-                })
+def to_json(memory: list[tuple[int, int]], program: list[Instruction], labels: dict[str, int]) -> dict[str, list[dict]]:
+    instructions: list[dict[str, str | int]] = []
+    for idx, instruction in enumerate(program):
+        if instruction.operand is None:
+            instructions.append({"idx": idx, "opcode": instruction.opcode.value})
         else:
-            processed_code.append({
-                "idx": idx,
-                "opcode": parts[0],
-            })
-
-        idx += 1
-
-    for name, lines in labels.items():
-        for line in lines[1:]:
-            parts = line.split()
-            if len(parts) == 2:
-                if parts[1] in labels_to_idx.keys():
-                    processed_labels.append({
-                        "idx": idx,
-                        "opcode": parts[0],
-                        "operand": labels_to_idx[parts[1]]
-                    })
-                elif parts[1] in variables_to_idx.keys():
-                    processed_labels.append({
-                        "idx": idx,
-                        "opcode": parts[0],
-                        "operand": variables_to_idx[parts[1]]
-                    })
-                else:
-                    processed_labels.append({
-                        "idx": idx,
-                        "opcode": parts[0],
-                        "operand": int(parts[1])
-                    })
-            else:
-                processed_labels.append({
-                    "idx": idx,
-                    "opcode": parts[0],
-                })
-
-            idx += 1
+            instructions.append({"idx": idx, "opcode": instruction.opcode.value, "operand": instruction.operand})
 
-    result = {
-        "memory": processed_variables,  # { idx: xx , size: xx }
-        "instructions": processed_code + processed_labels  # { idx: xx , opcode: xx , operand: xx }
+    return {
+        "memory": [{"idx": idx, "size": size} for idx, size in memory],
+        "instructions": instructions,
+        "labels": [{"name": name, "idx": idx} for name, idx in labels.items()],
     }
 
-    return result
-
 
-def translate(source_path: str, dest_path: str) -> None:
-    term_lst: list[str] = []
+def translate(source_path: str, dest_path: str, binary: bool = False, optimized: bool = False,
+              inline_threshold: int = 0, tail_calls: bool = False, object_cache: ObjectCache | None = None) -> None:
+    if object_cache is not None:
+        with open(source_path, "rb") as source:
+            key = object_cache.key(source.read(), binary, optimized, inline_threshold, tail_calls)
+        if object_cache.get(key, dest_path):
+            logging.info(f"Object cache hit: {key[:16]}")
+            return
+        translate(source_path, dest_path, binary, optimized, inline_threshold, tail_calls)
+        object_cache.put(key, dest_path)
+        return
 
+    folded: Counter[str] = Counter()
     with open(source_path, "r") as in_file:
-        for line in in_file.readlines():
-            term_lst.extend(line.strip().split())
-
-    variables, instructions, procedures = terms_to_assembly(term_lst)
+        terms = tokenize(in_file)
+        variables, instructions, procedures = terms_to_assembly(fold_constants(terms, folded) if optimized else terms)
+    system_variables: tuple[str, ...] = SYSTEM_VARIABLES
+
+    if optimized or inline_threshold or tail_calls:
+        # the unfolded program differs from this one only by the instructions of the folded words
+        size = program_size(instructions, procedures) + sum(
+            count * program_size(term_instructions(term), {}) for term, count in folded.items())
+        ticks = program_ticks(instructions, procedures) + sum(
+            count * program_ticks(term_instructions(term), {}) for term, count in folded.items())
+        instructions, procedures = optimize(instructions, procedures, optimized, inline_threshold, tail_calls)
+
+        if optimized:
+            reachable = eliminate_dead_code(instructions, procedures)
+            used = referenced_names(instructions, reachable)
+            removed = [name for name in procedures if name not in reachable]
+            unused = [name for name in (*SYSTEM_VARIABLES, *variables) if name not in used]
+            logging.info(f"Removed unreachable blocks: {', '.join(removed) or '-'}; "
+                         f"unused variables: {', '.join(unused) or '-'}")
+
+            procedures = reachable
+            variables = {name: cells for name, cells in variables.items() if name in used}
+            system_variables = tuple(name for name in SYSTEM_VARIABLES if name in used)
+
+        logging.info(f"Optimizer: {size} -> {program_size(instructions, procedures)} instructions, "
+                     f"{ticks} -> {program_ticks(instructions, procedures)} ticks (static estimate)")
 
     # with open(dest_path, "w") as out_file:
     #     out_file.write(".data\n")
@@ -411,14 +345,37 @@ def translate(source_path: str, dest_path: str) -> None:
     #         for line in procedure:
     #             out_file.write(f"{line}\n")
 
-    json_dict = asm_to_machine(variables, instructions, procedures)
+    memory, program, labels = link(variables, instructions, procedures, system_variables)
+
+    if binary:
+        write_object(dest_path, memory, [encode(line.opcode, line.operand) for line in program], labels)
+        return
 
     with open(dest_path, "w", encoding="utf-8") as out_file:
-        json.dump(json_dict, out_file, indent=2)
+        # one write instead of one per JSON token
+        out_file.write(json.dumps(to_json(memory, program, labels), indent=2))
 
 
 if __name__ == "__main__":
-    assert len(sys.argv) == 3, "Usage: python translator.py <source> <target>"
-    translate(sys.argv[1], sys.argv[2])
+    parser = argparse.ArgumentParser(description="Translate a Forth program")
+    parser.add_argument("source")
+    parser.add_argument("target")
+    parser.add_argument("--binary", action="store_true",
+                        help="write a packed binary object instead of the JSON debug format")
+    parser.add_argument("-O", "--optimize", action="store_true",
+                        help="rewrite the generated assembly into shorter equivalent sequences")
+    parser.add_argument("--inline", type=int, default=0, metavar="N",
+                        help="inline procedures of at most N instructions (0 disables inlining)")
+    parser.add_argument("--tail-calls", action="store_true",
+                        help="replace a call right before ret with a jump")
+    parser.add_argument("--cache", metavar="DIR",
+                        help="reuse objects translated earlier from the same source with the same options")
+    parser.add_argument("--cache-size", type=int, default=64 << 20, metavar="BYTES",
+                        help="remove least recently used objects from the cache above that size")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    translate(args.source, args.target, args.binary, args.optimize, args.inline, args.tail_calls,
+              ObjectCache(args.cache, args.cache_size) if args.cache else None)
 
     # translate("golden/src/prob2.4th", "dest.o")